@@ -0,0 +1,319 @@
+"""Benchmark the screen recorder's capture/convert/encode pipeline
+
+Records a moving synthetic screen at each resolution preset and writes the results
+as JSON, so runs before and after a change can be compared:
+
+    python benchmark_recorder.py -d 10 -o before.json
+
+Each resolution is recorded in a fresh process so CPU time and peak memory are not
+carried over between runs.
+
+With --startup it instead measures how long importing the recorder takes, using
+python -X importtime in fresh interpreters, and lists any heavy module that was
+loaded eagerly:
+
+    python benchmark_recorder.py --startup --max-import-ms 100
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# resource is Unix-only; on Windows peak RSS is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Modules the recorder should only import once a feature needs them
+HEAVY_MODULES = ("cv2", "numpy", "pyaudio", "moviepy", "pyautogui", "asyncio", "soundfile", "tkinter")
+
+
+def parse_size(value):
+    """Parse a WIDTHxHEIGHT command-line size"""
+    try:
+        width, height = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT")
+    return (width, height)
+
+
+def resource_usage():
+    """CPU seconds used by this process and by finished child processes (ffmpeg)"""
+    if resource is None:
+        return {"recorder": time.process_time(), "encoder": None}
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "recorder": own.ru_utime + own.ru_stime,
+        "encoder": children.ru_utime + children.ru_stime,
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MiB, or None if it cannot be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_one(settings):
+    """Record one resolution and return its measurements; runs in a child process"""
+    # Keep the recorder's progress output off stdout, which may carry the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        import screen_recorder
+
+        width, height = settings["screen"]
+        config = screen_recorder.RecordingConfig(
+            output_filename=settings["output"],
+            resolution=screen_recorder.CLI_RESOLUTIONS[settings["resolution"]],
+            fps=settings["fps"],
+            capture_backend=settings["backend"],
+            capture_options={"width": width, "height": height},
+            video_encoder=settings["encoder"],
+            encoder_options=settings["encoder_options"],
+            skip_unchanged_frames=settings["skip_unchanged_frames"],
+        )
+        engine = screen_recorder.RecordingEngine(config)
+
+        cpu_before = resource_usage()
+        wall_started = time.perf_counter()
+        engine.start()
+        while engine.error is None and engine.elapsed() < settings["duration"]:
+            time.sleep(0.05)
+        elapsed = engine.elapsed()
+        pipeline = engine.frame_pipeline
+        session = engine.recording_session
+        engine.stop()
+        wall_time = time.perf_counter() - wall_started
+        cpu_after = resource_usage()
+
+    cpu_time = {}
+    for key in cpu_before:
+        if cpu_before[key] is not None:
+            cpu_time[key] = cpu_after[key] - cpu_before[key]
+
+    output = engine.output_filename
+    output_bytes = os.path.getsize(output) if os.path.exists(output) else 0
+    if not settings["keep"] and os.path.exists(output):
+        os.remove(output)
+
+    return {
+        "resolution": settings["resolution"],
+        "screen_size": list(session.source_size),
+        "output_size": list(session.output_size),
+        "target_fps": settings["fps"],
+        "duration_s": elapsed,
+        "wall_time_s": wall_time,
+        "frames_captured": pipeline.frames_captured,
+        "frames_written": pipeline.frames_written,
+        "achieved_fps": pipeline.frames_captured / elapsed if elapsed else 0.0,
+        "dropped_frames": pipeline.dropped_frames,
+        "duplicated_frames": pipeline.duplicated_frames,
+        "skipped_frames": pipeline.skipped_frames,
+        "stages": engine.latency_stats(),
+        "cpu_time_s": cpu_time,
+        "cpu_utilization": sum(cpu_time.values()) / wall_time if wall_time else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "output_bytes": output_bytes,
+        "error": str(engine.error) if engine.error is not None else None,
+    }
+
+
+def parse_importtime(stderr, module):
+    """Total import time of module and the imports it triggered, from -X importtime output
+
+    Returns (total microseconds, [(name, cumulative microseconds)] of direct imports).
+    """
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue  # the column header
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+
+        # Children are reported before their parent
+        if depth == 0:
+            if name == module:
+                return cumulative, children
+            children = []
+        elif depth == 1:
+            children.append((name, cumulative))
+    raise RuntimeError(f"{module} was not imported")
+
+
+def measure_startup(runs):
+    """Import the recorder in fresh interpreters and report the import time"""
+    code = ("import sys, screen_recorder; "
+            f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    totals = []
+    slowest = {}
+    eager = set()
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                 cwd=here, capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.strip().splitlines()[-1])
+        total, children = parse_importtime(process.stderr, "screen_recorder")
+        totals.append(total / 1000)
+        for name, cumulative in children:
+            slowest.setdefault(name, []).append(cumulative / 1000)
+        eager.update(filter(None, process.stdout.strip().split(",")))
+
+    imports = sorted(((name, statistics.median(times)) for name, times in slowest.items()),
+                     key=lambda item: item[1], reverse=True)
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "runs": runs,
+        "import_ms": {
+            "median": statistics.median(totals),
+            "min": min(totals),
+            "max": max(totals),
+        },
+        "slowest_imports_ms": {name: ms for name, ms in imports[:10]},
+        "heavy_modules_loaded": sorted(eager),
+    }
+
+
+def run_startup(args):
+    """Report import time; fails if it is over budget or a heavy module loads eagerly"""
+    report = measure_startup(args.runs)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    print(f"Import took {report['import_ms']['median']:.1f} ms (median of {args.runs})",
+          file=sys.stderr)
+    failed = False
+    if report["heavy_modules_loaded"]:
+        print(f"Loaded at import: {', '.join(report['heavy_modules_loaded'])}", file=sys.stderr)
+        failed = True
+    if args.max_import_ms and report["import_ms"]["median"] > args.max_import_ms:
+        print(f"Over the {args.max_import_ms:g} ms budget", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+def build_arg_parser():
+    """Command-line options for the benchmark"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the screen recorder pipeline with a synthetic moving screen.")
+    parser.add_argument("-r", "--resolutions", nargs="+", default=["720p", "1080p", "4k"],
+                        choices=["720p", "1080p", "4k"], help="resolution presets to record")
+    parser.add_argument("-d", "--duration", type=float, default=5.0,
+                        help="seconds to record at each resolution (default: 5)")
+    parser.add_argument("--fps", type=float, default=30.0, help="target frame rate (default: 30)")
+    parser.add_argument("--screen", type=parse_size, default=(3840, 2160),
+                        help="size of the synthetic screen (default: 3840x2160)")
+    parser.add_argument("--backend", default="mock", choices=["mock", "synthetic"],
+                        help="synthetic frame source: the pyautogui mock or raw BGRA frames")
+    parser.add_argument("--encoder", default="auto", choices=["auto", "ffmpeg", "opencv"],
+                        help="video encoder (default: auto)")
+    parser.add_argument("--codec", default="libx264", help="ffmpeg video codec")
+    parser.add_argument("--preset", default="veryfast", help="ffmpeg encoder preset")
+    parser.add_argument("--crf", type=int, default=23, help="ffmpeg constant rate factor")
+    parser.add_argument("--threads", type=int, default=0, help="ffmpeg encoder threads")
+    parser.add_argument("--no-skip-unchanged", dest="skip_unchanged_frames", action="store_false",
+                        help="disable static screen detection")
+    parser.add_argument("--keep", action="store_true", help="keep the recorded videos")
+    parser.add_argument("-o", "--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure how long importing the recorder takes instead of recording")
+    parser.add_argument("--runs", type=int, default=5, help="imports to time with --startup (default: 5)")
+    parser.add_argument("--max-import-ms", type=float, metavar="MS",
+                        help="with --startup, fail if the median import time exceeds MS")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.startup:
+        return run_startup(args)
+
+    workdir = os.getcwd() if args.keep else tempfile.mkdtemp(prefix="recorder_benchmark_")
+    encoder_options = {"codec": args.codec, "preset": args.preset,
+                       "crf": args.crf, "threads": args.threads}
+
+    runs = []
+    # A fresh spawned process per run keeps CPU time and peak RSS per resolution
+    context = multiprocessing.get_context("spawn")
+    for resolution in args.resolutions:
+        settings = {
+            "resolution": resolution,
+            "duration": args.duration,
+            "fps": args.fps,
+            "screen": args.screen,
+            "backend": args.backend,
+            "encoder": args.encoder,
+            "encoder_options": encoder_options,
+            "skip_unchanged_frames": args.skip_unchanged_frames,
+            "keep": args.keep,
+            "output": os.path.join(workdir, f"benchmark_{resolution}.mp4"),
+        }
+        print(f"Recording {resolution} for {args.duration:g}s...", file=sys.stderr)
+        with context.Pool(1) as pool:
+            result = pool.apply(run_one, (settings,))
+        print(f"  {result['achieved_fps']:.1f} fps, {result['dropped_frames']} dropped, "
+              f"{result['output_bytes'] / 1e6:.1f} MB", file=sys.stderr)
+        runs.append(result)
+
+    if not args.keep:
+        try:
+            os.rmdir(workdir)
+        except OSError:
+            pass
+
+    import cv2
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "duration": args.duration,
+            "fps": args.fps,
+            "screen": list(args.screen),
+            "backend": args.backend,
+            "encoder": args.encoder,
+            "encoder_options": encoder_options,
+            "skip_unchanged_frames": args.skip_unchanged_frames,
+        },
+        "runs": runs,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if all(run["error"] is None for run in runs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,83 +1,3979 @@
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-import cv2
-import numpy as np
-import pyaudio
+import argparse
+import importlib
+import importlib.util
+import sys
 import wave
 import threading
+import queue
 import time
+import math
 import os
+import json
+import shutil
+import subprocess
+from collections import deque
 from datetime import datetime
+from typing import TYPE_CHECKING
 
-# Import moviepy for audio-video muxing
+# The modules below are imported lazily by name, which PyInstaller cannot see. These
+# never-executed imports let its bytecode scan find them, so a plain
+# "pyinstaller screen_recorder.py" still bundles them
+if TYPE_CHECKING:
+    import asyncio
+    import cv2
+    import imageio_ffmpeg
+    import moviepy
+    import moviepy.editor
+    import numpy
+    import pyaudio
+    import pyautogui
+    import soundfile
+
+# Tkinter is imported only when the GUI starts, so headless runs never load it
+tk = ttk = messagebox = filedialog = None
+
+
+def load_tkinter():
+    """Import Tkinter on demand for the GUI"""
+    global tk, ttk, messagebox, filedialog
+    if tk is None:
+        import tkinter
+        from tkinter import ttk as tkinter_ttk, messagebox as tkinter_messagebox, \
+            filedialog as tkinter_filedialog
+        tk, ttk, messagebox, filedialog = \
+            tkinter, tkinter_ttk, tkinter_messagebox, tkinter_filedialog
+
+
+class LazyModule:
+    """Stand-in for a module that is only imported when one of its attributes is used
+    
+    Keeps heavy imports off the startup path. Looked-up attributes are cached on the
+    stand-in, so per-frame calls cost no more than on the module itself.
+    """
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        value = getattr(self._module, attr)
+        setattr(self, attr, value)
+        return value
+
+
+# cv2 and NumPy are needed once a recording starts, asyncio only for live streaming
+# and PyAudio only when an audio input is selected
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+asyncio = LazyModule("asyncio")
+pyaudio = LazyModule("pyaudio")
+
+# Optional modules are probed and imported the first time they are needed
+_optional_modules = {}
+
+
+def optional_import(name, errors=(ImportError,)):
+    """Import an optional module once; returns None if it is missing or fails to load"""
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except errors:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
+
+def module_installed(name):
+    """Whether a module can be found, without importing it"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def moviepy_available():
+    """Whether MoviePy is installed for re-encoding merges; it is imported only to merge"""
+    return module_installed("moviepy")
+
+
+def load_moviepy():
+    """Import the MoviePy module that provides the clip classes, or None
+    
+    MoviePy 2 removed moviepy.editor and exports the clips from the package itself.
+    """
+    return optional_import("moviepy.editor") or optional_import("moviepy")
+
+
+# pyautogui is imported on first use; it is None until then
+pyautogui = None
+
+
+def load_pyautogui():
+    """Import pyautogui, falling back to MockPyAutoGUI where it cannot load (no display)"""
+    global pyautogui
+    if pyautogui is None:
+        # Importing pyautogui without an X11 display raises more than ImportError
+        module = optional_import("pyautogui", errors=(Exception,))
+        if module is not None:
+            # Disable failsafe for automated environments
+            module.FAILSAFE = False
+        pyautogui = module or MockPyAutoGUI()
+    return pyautogui
+
+
+def pyautogui_available():
+    """Whether real pyautogui (not the mock) can capture the screen"""
+    return not isinstance(load_pyautogui(), MockPyAutoGUI)
+
+
+def __getattr__(name):
+    """Availability flags from before the probes were lazy, for code that still reads them"""
+    if name == "MOVIEPY_AVAILABLE":
+        return moviepy_available()
+    if name == "PYAUTOGUI_AVAILABLE":
+        return pyautogui_available()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# mss grabs raw BGRA screen buffers without going through PIL
 try:
-    from moviepy.editor import VideoFileClip, AudioFileClip
-    MOVIEPY_AVAILABLE = True
+    import mss
+    MSS_AVAILABLE = True
 except ImportError:
-    MOVIEPY_AVAILABLE = False
+    mss = None
+    MSS_AVAILABLE = False
+
+# Mock pyautogui functions for headless environments
+class MockPyAutoGUI:
+    """Stand-in for pyautogui that draws a moving test pattern instead of a black screen"""
+    
+    def __init__(self, width=1920, height=1080, speed=8):
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self._offset = 0
+        self._strip = None
+    
+    def size(self):
+        return (self.width, self.height)  # Default screen size
+    
+    def _pattern(self):
+        """Render a strip twice the screen width once; screenshots slide across it"""
+        if self._strip is None:
+            x = np.arange(2 * self.width) % self.width
+            y = np.arange(self.height)[:, None]
+            strip = np.empty((self.height, 2 * self.width, 3), dtype=np.uint8)
+            strip[..., 0] = (((x // 64) + (y // 64)) % 2 * 255).astype(np.uint8)
+            strip[..., 1] = (y * 255 // max(1, self.height - 1)).astype(np.uint8)
+            strip[..., 2] = (x * 255 // max(1, self.width - 1)).astype(np.uint8)
+            self._strip = strip
+        return self._strip
+    
+    def screenshot(self, region=None):
+        # Create a mock screenshot that scrolls a little on every call
+        from PIL import Image
+        left, top, width, height = (0, 0, self.width, self.height) if region is None else region
+        offset = self._offset
+        self._offset = (offset + self.speed) % self.width
+        view = self._pattern()[top:top + height, offset + left:offset + left + width]
+        return Image.fromarray(np.ascontiguousarray(view))
+
+
+class CaptureBackend:
+    """Base class for screen capture sources
+    
+    grab() returns an H x W x C uint8 array whose channel order is given by pixel_format.
+    """
+    name = "base"
+    pixel_format = "BGR"
+    
+    def size(self):
+        """Return the (width, height) of the captured area"""
+        raise NotImplementedError
+    
+    def monitors(self):
+        """Return (left, top, width, height) for each monitor this backend can see"""
+        width, height = self.size()
+        return [(0, 0, width, height)]
+    
+    def grab(self, bounds=None):
+        """Capture one frame, limited to bounds (left, top, width, height) if given"""
+        raise NotImplementedError
+    
+    def close(self):
+        """Release any resources held by the backend"""
+        pass
+
+
+class PyAutoGUICaptureBackend(CaptureBackend):
+    """Capture through pyautogui (or MockPyAutoGUI in headless environments)"""
+    name = "pyautogui"
+    pixel_format = "RGB"
+    
+    def __init__(self, module=None):
+        self.module = module
+    
+    def size(self):
+        return tuple((self.module or load_pyautogui()).size())
+    
+    def grab(self, bounds=None):
+        module = self.module or load_pyautogui()
+        if bounds is None:
+            return np.asarray(module.screenshot())
+        return np.asarray(module.screenshot(region=tuple(bounds)))
+
+
+class MssCaptureBackend(CaptureBackend):
+    """Capture with mss, exposing its BGRA buffer as a NumPy view without copying"""
+    name = "mss"
+    pixel_format = "BGRA"
+    
+    def __init__(self, monitor=1):
+        if not MSS_AVAILABLE:
+            raise RuntimeError("mss is not installed")
+        # mss.monitors[0] spans every screen, [1] is the primary monitor
+        self.monitor_index = monitor
+        self._local = threading.local()
+        self._grabbers = []
+        self._lock = threading.Lock()
+    
+    def _grabber(self):
+        """Return the grabber for the calling thread, creating it once"""
+        # mss handles are tied to the thread that created them
+        sct = getattr(self._local, "sct", None)
+        if sct is None:
+            sct = mss.mss()
+            self._local.sct = sct
+            with self._lock:
+                self._grabbers.append(sct)
+        return sct
+    
+    def monitor(self):
+        """Return the mss monitor dict being captured"""
+        return self._grabber().monitors[self.monitor_index]
+    
+    def size(self):
+        monitor = self.monitor()
+        return (monitor["width"], monitor["height"])
+    
+    def monitors(self):
+        return [(m["left"], m["top"], m["width"], m["height"])
+                for m in self._grabber().monitors[1:]]
+    
+    def grab(self, bounds=None):
+        if bounds is None:
+            area = self.monitor()
+        else:
+            left, top, width, height = bounds
+            area = {"left": left, "top": top, "width": width, "height": height}
+        shot = self._grabber().grab(area)
+        return np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+    
+    def close(self):
+        with self._lock:
+            grabbers, self._grabbers = self._grabbers, []
+        for sct in grabbers:
+            try:
+                sct.close()
+            except Exception:
+                pass
+
+
+class SyntheticCaptureBackend(CaptureBackend):
+    """Generate moving test frames so capture can be benchmarked without a display
+    
+    With monitors > 1 the desktop is that many width x height screens side by side.
+    """
+    name = "synthetic"
+    pixel_format = "BGRA"
+    
+    def __init__(self, width=1920, height=1080, speed=8, monitors=1):
+        self.monitor_width = width
+        self.monitor_count = max(1, monitors)
+        width *= self.monitor_count
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self._offset = 0
+        
+        # Render a strip twice the screen width; each frame is a view sliding across it
+        x = np.arange(2 * width) % width
+        y = np.arange(height)[:, None]
+        strip = np.empty((height, 2 * width, 4), dtype=np.uint8)
+        strip[..., 0] = (x * 255 // max(1, width - 1)).astype(np.uint8)
+        strip[..., 1] = (y * 255 // max(1, height - 1)).astype(np.uint8)
+        strip[..., 2] = (((x // 64) + (y // 64)) % 2 * 255).astype(np.uint8)
+        strip[..., 3] = 255
+        strip.flags.writeable = False
+        self._strip = strip
+    
+    def size(self):
+        return (self.width, self.height)
+    
+    def monitors(self):
+        return [(index * self.monitor_width, 0, self.monitor_width, self.height)
+                for index in range(self.monitor_count)]
+    
+    def grab(self, bounds=None):
+        offset = self._offset
+        self._offset = (offset + self.speed) % self.width
+        frame = self._strip[:, offset:offset + self.width]
+        if bounds is not None:
+            left, top, width, height = bounds
+            frame = frame[top:top + height, left:left + width]
+        return frame
+
+
+CAPTURE_BACKENDS = {
+    "mss": MssCaptureBackend,
+    "pyautogui": PyAutoGUICaptureBackend,
+    "synthetic": SyntheticCaptureBackend,
+}
+
+
+def list_monitors():
+    """Return (left, top, width, height) for each physical monitor"""
+    if MSS_AVAILABLE:
+        try:
+            with mss.mss() as sct:
+                return [(m["left"], m["top"], m["width"], m["height"]) for m in sct.monitors[1:]]
+        except Exception:
+            pass
+    width, height = load_pyautogui().size()
+    return [(0, 0, width, height)]
+
+
+def find_window(title=None, exclude_title=None):
+    """Return the first window whose title contains title
+    
+    With no title the topmost visible window is used, skipping any window titled
+    exclude_title (the recorder itself). Returns None when nothing matches or window
+    lookup is not supported on this platform.
+    """
+    try:
+        import pygetwindow
+        if title:
+            windows = pygetwindow.getWindowsWithTitle(title)
+        else:
+            windows = [pygetwindow.getActiveWindow()] + pygetwindow.getAllWindows()
+    except Exception:
+        return None
+    
+    for window in windows:
+        if window is None or not window.title or window.title == exclude_title:
+            continue
+        if window_bounds(window) is not None:
+            return window
+    return None
+
+
+def window_bounds(window):
+    """Return the current (left, top, width, height) of a window, or None if it is minimised"""
+    try:
+        if window.isMinimized or window.width <= 0 or window.height <= 0:
+            return None
+        return (window.left, window.top, window.width, window.height)
+    except Exception:
+        return None
+
+
+def clip_bounds(bounds, area):
+    """Clip bounds to area and round the size down to even numbers for the encoder"""
+    left, top, width, height = bounds
+    area_left, area_top, area_width, area_height = area
+    
+    right = min(left + width, area_left + area_width)
+    bottom = min(top + height, area_top + area_height)
+    left = max(left, area_left)
+    top = max(top, area_top)
+    
+    width = (right - left) // 2 * 2
+    height = (bottom - top) // 2 * 2
+    if width <= 0 or height <= 0:
+        return None
+    return (left, top, width, height)
+
+
+class CaptureRegion:
+    """Which part of the desktop to record: everything, a rectangle, one monitor or a window"""
+    
+    MODES = ("full", "rect", "monitor", "window")
+    
+    def __init__(self, mode="full", rect=None, monitor=1, window_title=None, exclude_title=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown capture region mode: {mode}")
+        if mode == "rect" and rect is None:
+            raise ValueError("Rectangle capture needs a rect")
+        self.mode = mode
+        self.rect = rect
+        self.monitor = monitor
+        self.window_title = window_title
+        self.exclude_title = exclude_title
+        self.window = None
+    
+    @property
+    def follows_window(self):
+        return self.mode == "window"
+    
+    def resolve(self, backend):
+        """Return the bounds to grab from backend, or None for its whole area"""
+        if self.mode == "full":
+            return None
+        
+        monitors = backend.monitors()
+        
+        if self.mode == "monitor":
+            if not 1 <= self.monitor <= len(monitors):
+                raise ValueError(f"Monitor {self.monitor} not found ({len(monitors)} available)")
+            return clip_bounds(monitors[self.monitor - 1], monitors[self.monitor - 1])
+        
+        if self.mode == "rect":
+            bounds = self.rect
+        else:
+            # Lock onto one window so the region follows it rather than the focus
+            self.window = find_window(self.window_title, self.exclude_title)
+            bounds = window_bounds(self.window) if self.window is not None else None
+            if bounds is None:
+                raise ValueError("Window to record was not found")
+        
+        bounds = clip_bounds(bounds, desktop_bounds(monitors))
+        if bounds is None:
+            raise ValueError("Capture region lies outside the desktop")
+        return bounds
+
+
+def desktop_bounds(monitors):
+    """Return the rectangle spanning all monitors"""
+    left = min(m[0] for m in monitors)
+    top = min(m[1] for m in monitors)
+    right = max(m[0] + m[2] for m in monitors)
+    bottom = max(m[1] + m[3] for m in monitors)
+    return (left, top, right - left, bottom - top)
+
+
+class RegionCapture:
+    """Grab only the configured region, re-locating it periodically when following a window"""
+    
+    WINDOW_REFRESH_INTERVAL = 0.5
+    
+    def __init__(self, backend, region=None):
+        self.backend = backend
+        self.region = region or CaptureRegion()
+        self.bounds = self.region.resolve(backend)
+        self.pixel_format = backend.pixel_format
+        self._desktop = desktop_bounds(backend.monitors())
+        self._refreshed_at = time.monotonic()
+    
+    def size(self):
+        """Size of the region as it was when recording started"""
+        if self.bounds is None:
+            return tuple(self.backend.size())
+        return tuple(self.bounds[2:])
+    
+    def grab(self):
+        if self.region.follows_window:
+            now = time.monotonic()
+            if now - self._refreshed_at >= self.WINDOW_REFRESH_INTERVAL:
+                self._refreshed_at = now
+                # Keep the last known position while the window is minimised or gone
+                bounds = window_bounds(self.region.window)
+                if bounds is not None:
+                    bounds = clip_bounds(bounds, self._desktop)
+                if bounds is not None:
+                    self.bounds = bounds
+        return self.backend.grab(self.bounds)
+
+
+class MultiMonitorCapture:
+    """Capture every monitor on its own thread and composite them side by side
+    
+    Each monitor thread grabs at the recording frame rate and keeps only its newest
+    frame, so a slow display repeats its last image instead of holding up the others.
+    grab() copies the newest frame of every monitor into a pooled canvas, which must be
+    handed back with release() once it has been converted.
+    """
+    
+    def __init__(self, backend, fps, monitors=None):
+        self.backend = backend
+        self.fps = fps
+        self.pixel_format = backend.pixel_format
+        self.monitors = [clip_bounds(m, m) for m in (monitors or backend.monitors())]
+        
+        # Lay the monitors out left to right, top-aligned, in their listed order
+        self.tiles = []
+        x = 0
+        for _, _, width, height in self.monitors:
+            self.tiles.append((x, 0, width, height))
+            x += width
+        canvas_height = max(tile[3] for tile in self.tiles)
+        channels = 4 if self.pixel_format == "BGRA" else 3
+        self.canvases = FrameBufferPool((canvas_height, x, channels), 2, zeroed=True)
+        
+        self.paused = False
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+        self.running = False
+        self.frames_grabbed = [0] * len(self.monitors)
+        self.errors = [None] * len(self.monitors)
+        self._latest = [None] * len(self.monitors)
+        self._threads = []
+    
+    def size(self):
+        """Size of the side-by-side canvas"""
+        height, width = self.canvases.shape[:2]
+        return (width, height)
+    
+    def start(self):
+        """Grab one frame from every monitor, then start the monitor threads"""
+        for index, bounds in enumerate(self.monitors):
+            self._latest[index] = self.backend.grab(bounds)
+        
+        self.running = True
+        self._threads = [threading.Thread(target=self._capture_loop, args=(index,), daemon=True)
+                         for index in range(len(self.monitors))]
+        for thread in self._threads:
+            thread.start()
+    
+    def stop(self):
+        self.running = False
+        self._unpaused.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+    
+    def pause(self, now=None):
+        self.paused = True
+        self._unpaused.clear()
+    
+    def resume(self, now=None):
+        self.paused = False
+        self._unpaused.set()
+    
+    def _capture_loop(self, index):
+        """Keep the newest frame of one monitor, paced by its own scheduler"""
+        bounds = self.monitors[index]
+        scheduler = FrameScheduler(self.fps)
+        scheduler.start()
+        
+        while self.running:
+            if self.paused:
+                scheduler.pause()
+                self._unpaused.wait()
+                scheduler.resume()
+                continue
+            scheduler.wait()
+            
+            try:
+                self._latest[index] = self.backend.grab(bounds)
+                self.frames_grabbed[index] += 1
+            except Exception as e:
+                # Keep compositing the last good frame; report the problem once
+                if self.errors[index] is None:
+                    print(f"Monitor {index + 1} capture error: {e}")
+                self.errors[index] = e
+                time.sleep(0.1)
+    
+    def grab(self):
+        """Composite the newest frame of every monitor into a canvas"""
+        canvas = self.canvases.acquire()
+        for (x, y, width, height), frame in zip(self.tiles, self._latest):
+            np.copyto(canvas[y:y + height, x:x + width], frame[:height, :width])
+        return canvas
+    
+    def release(self, canvas):
+        """Give a canvas back to the pool"""
+        self.canvases.release(canvas)
+
+
+def fit_resolution(source_size, target_resolution):
+    """Scale source_size down to fit inside target_resolution, keeping its aspect ratio"""
+    source_width, source_height = source_size
+    target_width, target_height = target_resolution
+    scale = min(1.0, target_width / source_width, target_height / source_height)
+    return (int(source_width * scale) // 2 * 2, int(source_height * scale) // 2 * 2)
+
+
+def create_capture_backend(name="auto", **options):
+    """Create a capture backend by name
+    
+    "auto" prefers mss, then pyautogui; "mock" forces the headless MockPyAutoGUI.
+    """
+    if name == "auto":
+        if MSS_AVAILABLE:
+            try:
+                backend = MssCaptureBackend(**options)
+                backend.size()
+                return backend
+            except Exception as e:
+                print(f"mss capture unavailable, falling back to pyautogui: {e}")
+        return PyAutoGUICaptureBackend()
+    
+    if name == "mock":
+        return PyAutoGUICaptureBackend(MockPyAutoGUI(**options))
+    
+    if name not in CAPTURE_BACKENDS:
+        raise ValueError(f"Unknown capture backend: {name}")
+    return CAPTURE_BACKENDS[name](**options)
+
+
+# Sentinel used to shut down pipeline stages
+_STOP = object()
+
+# Placeholder for a captured frame identical to the previous one
+_REPEAT = object()
+
+
+class LatencyHistogram:
+    """Log-scale histogram of durations, cheap enough to update on every frame
+    
+    Bucket edges grow by 10% from 10 microseconds, so percentiles are within about 10%.
+    """
+    
+    MIN_SECONDS = 1e-5
+    GROWTH = 1.1
+    BUCKETS = 160
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Forget every recorded duration"""
+        with self._lock:
+            self.counts = [0] * (self.BUCKETS + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+    
+    def record(self, seconds):
+        """Add one duration in seconds"""
+        if seconds <= self.MIN_SECONDS:
+            index = 0
+        else:
+            index = min(self.BUCKETS, int(math.log(seconds / self.MIN_SECONDS, self.GROWTH)) + 1)
+        
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+    
+    def percentile(self, percent):
+        """Return the duration in seconds below which percent of the samples fall"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            target = percent / 100 * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= target and count:
+                    return min(self.MIN_SECONDS * self.GROWTH ** index, self.max)
+            return self.max
+    
+    def snapshot(self):
+        """Sample count, mean, percentiles and maximum in milliseconds"""
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p90_ms": self.percentile(90) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class FrameChangeDetector:
+    """Cheaply decide whether a captured frame differs from the previous one
+    
+    Compares every stride-th row of the frame against the same rows of the previous
+    frame. Changes confined to the skipped rows can be missed, so an unchanged run is
+    cut short every max_repeats frames to pick them up.
+    """
+    
+    def __init__(self, stride=2, tile_size=64, threshold=0, max_repeats=30):
+        self.stride = stride
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.max_repeats = max_repeats
+        self._previous = None
+        self._repeats = 0
+        self.frames_checked = 0
+        self.frames_unchanged = 0
+        self.dirty_fraction = 1.0
+    
+    def changed(self, frame):
+        """Return True if frame needs converting, False if the previous output can be reused"""
+        self.frames_checked += 1
+        
+        # Flatten each sampled row to bytes; rows of a capture are contiguous even
+        # when the frame itself is a view into a larger buffer
+        height, width, channels = frame.shape
+        sample = frame[::self.stride].reshape(-1, width * channels)
+        
+        if self._previous is None or self._previous.shape != sample.shape or \
+                self._repeats >= self.max_repeats:
+            self._previous = np.array(sample)
+            self._repeats = 0
+            self.dirty_fraction = 1.0
+            return True
+        
+        if self.threshold:
+            differs = np.abs(sample.astype(np.int16) - self._previous) > self.threshold
+        else:
+            differs = sample != self._previous
+        
+        if not differs.any():
+            self._repeats += 1
+            self.frames_unchanged += 1
+            self.dirty_fraction = 0.0
+            return False
+        
+        # Collapse the mask into one flag per tile to measure how much of the screen changed
+        rows = np.arange(0, differs.shape[0], max(1, self.tile_size // self.stride))
+        cols = np.arange(0, differs.shape[1], self.tile_size * channels)
+        dirty = np.logical_or.reduceat(np.logical_or.reduceat(differs, rows, axis=0), cols, axis=1)
+        self.dirty_fraction = float(dirty.mean())
+        
+        np.copyto(self._previous, sample)
+        self._repeats = 0
+        return True
+    
+    def reset(self):
+        """Forget the previous frame so the next one is always converted
+        
+        Needed when a changed frame is dropped before it is written: the captures after
+        it would otherwise compare as unchanged and repeat stale content.
+        """
+        self._previous = None
+        self._repeats = 0
+    
+    def stats(self):
+        """Counters describing how much work change detection saved"""
+        return {
+            "frames_checked": self.frames_checked,
+            "frames_unchanged": self.frames_unchanged,
+            "unchanged_ratio": self.frames_unchanged / max(1, self.frames_checked),
+            "dirty_fraction": self.dirty_fraction,
+        }
+
+
+class FrameBufferPool:
+    """Reusable output frame buffers shared by the conversion workers and the encoder
+    
+    zeroed buffers start black, for canvases that are only partly drawn over.
+    """
+    
+    def __init__(self, shape, count, zeroed=False):
+        self.shape = shape
+        self.zeroed = zeroed
+        self._free = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.allocations = 0
+        
+        for _ in range(count):
+            self._free.put_nowait(self._allocate())
+    
+    def _allocate(self):
+        with self._lock:
+            self.allocations += 1
+        if self.zeroed:
+            return np.zeros(self.shape, dtype=np.uint8)
+        return np.empty(self.shape, dtype=np.uint8)
+    
+    def acquire(self):
+        """Take a free buffer, allocating a new one only if the pool is exhausted"""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return self._allocate()
+    
+    def release(self, buffer):
+        """Return a buffer once the encoder is done with it"""
+        # Buffers from before an output size change are left to the garbage collector
+        if buffer.shape == self.shape:
+            self._free.put_nowait(buffer)
+
+
+class RecordingSession:
+    """Recording parameters locked in when recording starts, plus reusable conversion buffers"""
+    
+    # cvtColor codes that turn each capture pixel format into BGR, looked up on cv2
+    # when a session starts so importing this module does not load OpenCV
+    COLOR_CONVERSIONS = {
+        "RGB": "COLOR_RGB2BGR",
+        "BGRA": "COLOR_BGRA2BGR",
+        "BGR": None,
+    }
+    
+    def __init__(self, source_size, output_size, pixel_format, fps, buffer_count=16):
+        self.source_size = tuple(source_size)
+        self.pixel_format = pixel_format
+        self.fps = fps
+        conversion = self.COLOR_CONVERSIONS[pixel_format]
+        self.color_conversion = getattr(cv2, conversion) if conversion else None
+        self.buffer_count = buffer_count
+        self.buffers = None
+        self._retired_allocations = 0
+        self.set_output_size(output_size)
+        
+        self._scratch = threading.local()
+        self._count_lock = threading.Lock()
+        self.frames_converted = 0
+        self.started_at = time.monotonic()
+        self.resize_latency = LatencyHistogram()
+    
+    def set_output_size(self, output_size):
+        """Convert frames to a new size from the next frame on
+        
+        Frames already converted keep their old size; the buffer pool is replaced so
+        their buffers are not reused when they come back.
+        """
+        output_width, output_height = output_size
+        source_width, source_height = self.source_size
+        
+        # INTER_AREA averages source pixels when shrinking, which avoids aliasing on text
+        if output_width <= source_width and output_height <= source_height:
+            self.interpolation = cv2.INTER_AREA
+        else:
+            self.interpolation = cv2.INTER_LINEAR
+        
+        if self.buffers is not None:
+            self._retired_allocations += self.buffers.allocations
+        self.buffers = FrameBufferPool((output_height, output_width, 3), self.buffer_count)
+        self.output_size = (output_width, output_height)
+    
+    def _scratch_buffer(self, shape):
+        """Per-worker resize target, reused on every frame"""
+        buffer = getattr(self._scratch, "buffer", None)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            self._scratch.buffer = buffer
+        return buffer
+    
+    def convert(self, frame):
+        """Resize and convert a captured frame into a pooled BGR buffer"""
+        output = self.buffers.acquire()
+        # The output size is taken from the buffer in case it changes during the call
+        output_size = output.shape[1::-1]
+        
+        try:
+            if frame.shape[1::-1] != output_size:
+                # Resize first so the colour conversion only touches output-sized data
+                source = self._scratch_buffer(output.shape[:2] + frame.shape[2:])
+                started = time.perf_counter()
+                cv2.resize(frame, output_size, dst=source, interpolation=self.interpolation)
+                self.resize_latency.record(time.perf_counter() - started)
+            else:
+                source = frame
+            
+            if self.color_conversion is None:
+                np.copyto(output, source)
+            else:
+                cv2.cvtColor(source, self.color_conversion, dst=output)
+        except Exception:
+            self.buffers.release(output)
+            raise
+        
+        with self._count_lock:
+            self.frames_converted += 1
+        return output
+    
+    def release(self, frame):
+        """Give an output buffer back to the pool"""
+        self.buffers.release(frame)
+    
+    def stats(self):
+        """Conversion throughput and buffer allocation counters"""
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        return {
+            "frames_converted": self.frames_converted,
+            "conversion_fps": self.frames_converted / elapsed,
+            "buffer_allocations": self._retired_allocations + self.buffers.allocations,
+        }
+
+
+class FrameScheduler:
+    """Pace capture against absolute per-frame deadlines on the monotonic clock"""
+
+    def __init__(self, fps=30.0):
+        self.fps = float(fps)
+        self.interval = 1.0 / self.fps
+        self.start_time = None
+        self._paused_at = None
+        self._next_slot = 0
+        # Capture only every stride-th frame slot; the encoder repeats frames in between
+        self.stride = 1
+
+    @property
+    def capture_fps(self):
+        """Frames per second actually captured at the current stride"""
+        return self.fps / self.stride
+
+    def start(self):
+        """Anchor frame slot 0 to the current time"""
+        self.start_time = time.monotonic()
+        self._paused_at = None
+        self._next_slot = 0
+
+    def pause(self, now=None):
+        """Stop the media clock, at now if given, until resume is called"""
+        if self._paused_at is None:
+            self._paused_at = time.monotonic() if now is None else now
+
+    def resume(self, now=None):
+        """Shift the epoch so the paused interval is left out of the recording"""
+        if self._paused_at is not None:
+            self.start_time += (time.monotonic() if now is None else now) - self._paused_at
+            self._paused_at = None
+
+    def elapsed(self):
+        """Seconds of media recorded so far, not counting pauses"""
+        if self.start_time is None:
+            return 0.0
+        now = self._paused_at if self._paused_at is not None else time.monotonic()
+        return max(0.0, now - self.start_time)
+
+    def slot_for(self, timestamp):
+        """Return the output frame index a capture taken at timestamp belongs to"""
+        return int(round((timestamp - self.start_time) * self.fps))
+
+    def wait(self):
+        """Sleep until the next frame deadline, skipping deadlines already missed"""
+        deadline = self.start_time + self._next_slot * self.interval
+        now = time.monotonic()
+
+        if now < deadline:
+            time.sleep(deadline - now)
+        else:
+            # Running late: resume from the current slot instead of bursting to catch up
+            self._next_slot = self.slot_for(now)
+
+        self._next_slot += self.stride
+
+
+class FramePipeline:
+    """Capture, convert and encode frames on separate threads joined by bounded queues"""
+
+    DROP_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(self, capture_frame, convert_frame, write_frame, workers=2,
+                 queue_size=8, drop_policy="drop_oldest", fps=30.0, release_frame=None,
+                 change_detector=None, release_capture=None):
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+
+        self.capture_frame = capture_frame
+        self.convert_frame = convert_frame
+        self.write_frame = write_frame
+        self.release_frame = release_frame
+        # Called with each captured frame once it has been converted or dropped
+        self.release_capture = release_capture
+        self.change_detector = change_detector
+        self.workers = max(1, workers)
+        self.drop_policy = drop_policy
+        self.scheduler = FrameScheduler(fps)
+
+        # Bounded queues provide backpressure between the stages
+        self.queue_size = queue_size
+        self.convert_queue = queue.Queue(maxsize=queue_size)
+        self.encode_queue = queue.Queue(maxsize=queue_size)
+
+        # Workers number frames as they dequeue them so the encoder can restore order
+        self._take_lock = threading.Lock()
+        self._next_seq = 0
+
+        self.paused = False
+        # Set while not paused; the capture thread waits on it instead of polling
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+        self.running = False
+        self.error = None
+        self.frames_captured = 0
+        self.frames_written = 0
+        self.dropped_frames = 0
+        self.duplicated_frames = 0
+        self.skipped_frames = 0
+
+        # Time spent in each stage per frame; "convert" includes any resize
+        self.stage_latency = {
+            "capture": LatencyHistogram(),
+            "convert": LatencyHistogram(),
+            "encode": LatencyHistogram(),
+        }
+
+        # Capture times of roughly the last second of frames, for the real frame rate
+        self._recent_captures = deque(maxlen=max(2, int(round(fps))))
+
+        # When frame slot 0 was captured, for aligning audio when muxing
+        self.video_start_time = None
+
+        self._capture_thread = None
+        self._worker_threads = []
+        self._encoder_thread = None
+
+    def start(self):
+        """Start the encoder, the conversion workers and the capture thread"""
+        self.running = True
+        self.scheduler.start()
+        self.video_start_time = self.scheduler.start_time
+        self._encoder_thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self._worker_threads = [threading.Thread(target=self._convert_loop, daemon=True)
+                                for _ in range(self.workers)]
+        self._capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+
+        self._encoder_thread.start()
+        for thread in self._worker_threads:
+            thread.start()
+        self._capture_thread.start()
+
+    def stop(self):
+        """Stop capturing and drain the frames already in flight to the encoder"""
+        self.running = False
+        self._unpaused.set()
+
+        if self._capture_thread:
+            self._capture_thread.join()
+        # Freeze the media clock at the last capture
+        self.scheduler.pause()
+
+        # Queue order guarantees workers see every captured frame before the sentinel
+        for _ in self._worker_threads:
+            self.convert_queue.put(_STOP)
+        for thread in self._worker_threads:
+            thread.join()
+
+        if self._encoder_thread:
+            self.encode_queue.put(_STOP)
+            self._encoder_thread.join()
+
+    def pause(self, now=None):
+        """Stop capturing; now is the monotonic time the pause takes effect"""
+        self.paused = True
+        self._unpaused.clear()
+        self.scheduler.pause(now)
+
+    def resume(self, now=None):
+        """Carry on capturing, leaving the paused interval out of the recording"""
+        self.scheduler.resume(now)
+        self.paused = False
+        self._unpaused.set()
+
+    def _fail(self, stage, error):
+        """Record the first error and stop capturing new frames"""
+        print(f"Video {stage} error: {error}")
+        if self.error is None:
+            self.error = error
+        self.running = False
+
+    def _capture_loop(self):
+        """Grab a frame at each scheduler deadline and hand it to the conversion workers"""
+        scheduler = self.scheduler
+
+        try:
+            while self.running:
+                # Pausing and resuming adjust the scheduler directly, at the same moment
+                # audio is gated, so this thread only has to wait
+                if self.paused:
+                    self._unpaused.wait()
+                    continue
+
+                scheduler.wait()
+                if self.paused:
+                    continue  # Paused while waiting for the deadline
+                timestamp = time.monotonic()
+                started = time.perf_counter()
+                frame = self.capture_frame()
+                self.stage_latency["capture"].record(time.perf_counter() - started)
+                self.frames_captured += 1
+                self._recent_captures.append(timestamp)
+                
+                # Unchanged frames skip conversion entirely and are written as repeats
+                if self.change_detector is not None and not self.change_detector.changed(frame):
+                    self._release_capture(frame)
+                    frame = _REPEAT
+                    self.skipped_frames += 1
+
+                # The slot is fixed at capture time so later pauses cannot shift it
+                self._enqueue((scheduler.slot_for(timestamp), frame))
+        except Exception as e:
+            self._fail("capture", e)
+
+    def _enqueue(self, item):
+        """Queue a captured frame, applying the drop policy when workers fall behind"""
+        if self.drop_policy == "block":
+            while self.running:
+                try:
+                    self.convert_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+            self._drop(item[1])
+            return
+
+        try:
+            self.convert_queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+        if self.drop_policy == "drop_newest":
+            self._drop(item[1])
+            return
+
+        # Make room by discarding the stalest frame still waiting for a worker
+        try:
+            self._drop(self.convert_queue.get_nowait()[1])
+        except queue.Empty:
+            pass
+        try:
+            self.convert_queue.put_nowait(item)
+        except queue.Full:
+            self._drop(item[1])
+
+    def _drop(self, frame):
+        """Discard a captured frame before conversion; runs on the capture thread"""
+        self.dropped_frames += 1
+        self._release_capture(frame)
+        # Later captures were compared against the dropped one; make the next one a
+        # real frame so repeats do not keep writing what was on screen before it
+        if frame is not _REPEAT and self.change_detector is not None:
+            self.change_detector.reset()
+
+    def _convert_loop(self):
+        """Convert and resize frames; runs on several threads since cv2 releases the GIL"""
+        while True:
+            with self._take_lock:
+                item = self.convert_queue.get()
+                if item is _STOP:
+                    return
+                seq = self._next_seq
+                self._next_seq += 1
+
+            slot, frame = item
+            try:
+                if frame is _REPEAT:
+                    converted = frame
+                else:
+                    started = time.perf_counter()
+                    converted = self.convert_frame(frame)
+                    self.stage_latency["convert"].record(time.perf_counter() - started)
+            except Exception as e:
+                self._fail("conversion", e)
+                converted = None
+            self._release_capture(frame)
+
+            # Always forward the sequence number so the encoder never waits on a gap
+            self.encode_queue.put((seq, slot, converted))
+
+    def _encode_loop(self):
+        """Write converted frames in capture order at the declared frame rate"""
+        pending = {}
+        next_seq = 0
+        last_slot = -1
+        last_frame = None
+
+        while True:
+            item = self.encode_queue.get()
+            if item is _STOP:
+                break
+
+            seq, slot, frame = item
+            pending[seq] = (slot, frame)
+
+            while next_seq in pending:
+                slot, frame = pending.pop(next_seq)
+                next_seq += 1
+                if frame is None:
+                    continue
+                if self.error is not None:
+                    self._release(frame)
+                    continue
+
+                # Two captures landed in the same slot: keep the first
+                if slot <= last_slot:
+                    self.dropped_frames += 1
+                    if frame is not _REPEAT and last_frame is not None:
+                        # Repeats that follow refer to this newer capture
+                        self._release(last_frame)
+                        last_frame = frame
+                    else:
+                        self._release(frame)
+                    continue
+
+                if frame is _REPEAT:
+                    # Nothing changed on screen: write the previous output again
+                    if last_frame is None:
+                        continue
+                    try:
+                        for _ in range(slot - last_slot):
+                            self._write(last_frame)
+                        self.duplicated_frames += slot - last_slot - 1
+                    except Exception as e:
+                        self._fail("encoding", e)
+                        continue
+                    last_slot = slot
+                    continue
+
+                try:
+                    # Fill missed slots by repeating the previous frame so playback speed holds
+                    fill_frame = last_frame if last_frame is not None else frame
+                    for _ in range(slot - last_slot - 1):
+                        self._write(fill_frame)
+                        self.duplicated_frames += 1
+
+                    self._write(frame)
+                except Exception as e:
+                    self._fail("encoding", e)
+                    self._release(frame)
+                    continue
+
+                # The previous frame is only kept around for repeats
+                if last_frame is not None:
+                    self._release(last_frame)
+                last_slot = slot
+                last_frame = frame
+
+        if last_frame is not None:
+            self._release(last_frame)
+
+    def capture_fps(self):
+        """Frames actually captured per second over about the last second"""
+        recent = list(self._recent_captures)
+        if self.paused or len(recent) < 2 or time.monotonic() - recent[-1] > 1.0:
+            return 0.0
+        return (len(recent) - 1) / max(recent[-1] - recent[0], 1e-6)
+
+    def stats(self):
+        """Frame counters, real versus target frame rate and queue depths"""
+        elapsed = self.scheduler.elapsed()
+        return {
+            "target_fps": self.scheduler.fps,
+            "capture_target_fps": self.scheduler.capture_fps,
+            "capture_fps": self.capture_fps(),
+            "average_fps": self.frames_captured / elapsed if elapsed else 0.0,
+            "frames_captured": self.frames_captured,
+            "frames_written": self.frames_written,
+            "dropped_frames": self.dropped_frames,
+            "duplicated_frames": self.duplicated_frames,
+            "skipped_frames": self.skipped_frames,
+            "convert_queue": self.convert_queue.qsize(),
+            "encode_queue": self.encode_queue.qsize(),
+            "queue_size": self.queue_size,
+        }
+
+    def latency_stats(self):
+        """Per-stage latency percentiles in milliseconds"""
+        return {stage: histogram.snapshot() for stage, histogram in self.stage_latency.items()}
+
+    def _release_capture(self, frame):
+        """Give a captured frame back to the capture source once nothing needs it"""
+        if self.release_capture is not None and frame is not _REPEAT:
+            self.release_capture(frame)
+
+    def _release(self, frame):
+        """Hand a frame buffer back to its owner once it has been written"""
+        if self.release_frame is not None and frame is not _REPEAT:
+            self.release_frame(frame)
+
+    def _write(self, frame):
+        """Hand one output frame to the writer"""
+        started = time.perf_counter()
+        self.write_frame(frame)
+        self.stage_latency["encode"].record(time.perf_counter() - started)
+        self.frames_written += 1
+
+
+class AudioRingBuffer:
+    """Fixed-size byte ring between audio capture and the file writer
+    
+    Memory stays flat however long the recording runs; if the writer falls behind,
+    the newest audio that does not fit is dropped and counted.
+    """
+    
+    def __init__(self, capacity, frame_size=1):
+        # Keep whole sample frames together so dropping never splits a sample
+        self.frame_size = frame_size
+        self.capacity = max(frame_size, capacity // frame_size * frame_size)
+        self._buffer = bytearray(self.capacity)
+        self._view = memoryview(self._buffer)
+        self._read_pos = 0
+        self._size = 0
+        self._ready = threading.Condition()
+        self.dropped_bytes = 0
+    
+    def __len__(self):
+        return self._size
+    
+    def write(self, data):
+        """Append data, returning how many bytes did not fit and were dropped"""
+        with self._ready:
+            free = self.capacity - self._size
+            count = min(len(data), free) // self.frame_size * self.frame_size
+            
+            start = (self._read_pos + self._size) % self.capacity
+            first = min(count, self.capacity - start)
+            self._view[start:start + first] = data[:first]
+            self._view[:count - first] = data[first:count]
+            
+            self._size += count
+            dropped = len(data) - count
+            self.dropped_bytes += dropped
+            self._ready.notify()
+        return dropped
+    
+    def read(self, max_bytes, timeout=None):
+        """Remove and return up to max_bytes, waiting up to timeout for data to arrive"""
+        with self._ready:
+            if not self._size:
+                self._ready.wait(timeout)
+            
+            count = min(self._size, max_bytes) // self.frame_size * self.frame_size
+            start = self._read_pos
+            first = min(count, self.capacity - start)
+            data = bytes(self._view[start:start + first]) + bytes(self._view[:count - first])
+            
+            self._read_pos = (start + count) % self.capacity
+            self._size -= count
+        return data
+
+
+class AudioCaptureStats:
+    """Counters describing the health of the audio input stream"""
+    
+    def __init__(self):
+        self.buffers = 0
+        self.overflows = 0
+        self.underflows = 0
+        self.dropped_samples = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+    
+    def record_latency(self, latency):
+        self.latency = latency
+        self.max_latency = max(self.max_latency, latency)
+    
+    def snapshot(self):
+        """Return the counters as a plain dict"""
+        return {
+            "buffers": self.buffers,
+            "overflows": self.overflows,
+            "underflows": self.underflows,
+            "dropped_samples": self.dropped_samples,
+            "latency_ms": self.latency * 1000,
+            "max_latency_ms": self.max_latency * 1000,
+        }
+
+
+class AudioFileWriter:
+    """Stream PCM audio to a WAV, FLAC or headerless PCM file on disk as it arrives
+    
+    Raw "pcm" files are flushed on every write so ffmpeg can read them while recording.
+    """
+    
+    FORMATS = ("wav", "flac", "pcm")
+    
+    def __init__(self, path, channels, sample_width, rate, file_format="wav"):
+        if file_format not in self.FORMATS:
+            raise ValueError(f"Unknown audio format: {file_format}")
+        # soundfile (libsndfile) is only needed for FLAC output, so it is loaded here
+        soundfile = None
+        if file_format == "flac":
+            soundfile = optional_import("soundfile", errors=(ImportError, OSError))
+            if soundfile is None or sample_width not in (2, 3):
+                print("FLAC output unavailable, writing WAV instead")
+                file_format = "wav"
+                path = os.path.splitext(path)[0] + ".wav"
+        
+        self.path = path
+        self.channels = channels
+        self.sample_width = sample_width
+        self.rate = rate
+        self.file_format = file_format
+        self.frames_written = 0
+        
+        if file_format == "flac":
+            subtype = "PCM_16" if sample_width == 2 else "PCM_24"
+            self._file = soundfile.SoundFile(path, 'w', samplerate=rate, channels=channels,
+                                             format='FLAC', subtype=subtype)
+        elif file_format == "pcm":
+            self._file = open(path, 'wb')
+        else:
+            # wave fixes up the RIFF header sizes when the file is closed
+            self._file = wave.open(path, 'wb')
+            self._file.setnchannels(channels)
+            self._file.setsampwidth(sample_width)
+            self._file.setframerate(rate)
+    
+    def write(self, data):
+        """Append a block of interleaved PCM samples"""
+        if not data:
+            return
+        if self.file_format == "flac":
+            samples = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels) \
+                if self.sample_width == 2 else self._unpack_24bit(data)
+            self._file.write(samples)
+        elif self.file_format == "pcm":
+            self._file.write(data)
+            self._file.flush()
+        else:
+            self._file.writeframesraw(data)
+        self.frames_written += len(data) // (self.channels * self.sample_width)
+    
+    def _unpack_24bit(self, data):
+        """Widen packed 24-bit samples into int32 for soundfile"""
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        samples = np.zeros((raw.shape[0], 4), dtype=np.uint8)
+        samples[:, 1:] = raw
+        return samples.view(np.int32).reshape(-1, self.channels)
+    
+    def input_options(self):
+        """ffmpeg options needed to read the file; raw PCM has no header to describe it"""
+        if self.file_format != "pcm":
+            return []
+        sample_format = {1: "u8", 2: "s16le", 3: "s24le", 4: "s32le"}[self.sample_width]
+        return ["-f", sample_format, "-ar", str(self.rate), "-ac", str(self.channels)]
+    
+    def close(self):
+        """Finish the file so its header describes everything written"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ReplayAudioBuffer:
+    """Keep the most recent seconds of PCM audio in memory for the replay buffer
+    
+    Takes the place of AudioFileWriter: the audio writer thread appends blocks, and
+    old blocks are dropped once more than seconds of audio is held.
+    """
+    
+    file_format = "pcm"
+    path = None
+    
+    def __init__(self, seconds, channels, sample_width, rate):
+        self.channels = channels
+        self.sample_width = sample_width
+        self.rate = rate
+        self.frame_size = channels * sample_width
+        self.max_frames = int(seconds * rate)
+        self.frames_written = 0
+        self._chunks = deque()
+        self._frames_buffered = 0
+        self._lock = threading.Lock()
+    
+    def write(self, data):
+        """Append a block of interleaved PCM samples, evicting the oldest blocks"""
+        if not data:
+            return
+        frames = len(data) // self.frame_size
+        with self._lock:
+            self._chunks.append((self.frames_written, data))
+            self.frames_written += frames
+            self._frames_buffered += frames
+            while len(self._chunks) > 1 and \
+                    self._frames_buffered - len(self._chunks[0][1]) // self.frame_size >= self.max_frames:
+                _, oldest = self._chunks.popleft()
+                self._frames_buffered -= len(oldest) // self.frame_size
+    
+    def snapshot(self, start_frame=0):
+        """Return (first sample frame index, PCM bytes) for the audio from start_frame on"""
+        with self._lock:
+            chunks = [chunk for chunk in self._chunks
+                      if chunk[0] + len(chunk[1]) // self.frame_size > start_frame]
+        if not chunks:
+            return start_frame, b""
+        
+        first_frame, first = chunks[0]
+        skip = max(0, start_frame - first_frame)
+        chunks[0] = (first_frame + skip, first[skip * self.frame_size:])
+        return chunks[0][0], b"".join(data for _, data in chunks)
+    
+    def input_options(self):
+        return AudioFileWriter.input_options(self)
+    
+    def close(self):
+        with self._lock:
+            self._chunks.clear()
+            self._frames_buffered = 0
+
+
+# Keep ffmpeg from flashing a console window in the windowed build
+_NO_WINDOW = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+
+def get_ffmpeg_exe():
+    """Locate an ffmpeg binary, preferring the one bundled with imageio-ffmpeg"""
+    imageio_ffmpeg = optional_import("imageio_ffmpeg")
+    if imageio_ffmpeg is not None:
+        try:
+            return imageio_ffmpeg.get_ffmpeg_exe()
+        except Exception:
+            pass
+    return shutil.which("ffmpeg")
+
+
+class FinalizeCancelled(Exception):
+    """Post-processing was cancelled before it finished"""
+
+
+def run_ffmpeg(args, cancel=None):
+    """Run ffmpeg to completion, raising RuntimeError with its error output on failure
+    
+    If cancel (a threading.Event) is set while ffmpeg runs, the process is killed and
+    FinalizeCancelled is raised.
+    """
+    ffmpeg = get_ffmpeg_exe()
+    if not ffmpeg:
+        raise RuntimeError("ffmpeg not found")
+    if cancel is not None and cancel.is_set():
+        raise FinalizeCancelled("ffmpeg was cancelled")
+    
+    process = subprocess.Popen([ffmpeg, "-hide_banner", "-loglevel", "error", "-y", *args],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, creationflags=_NO_WINDOW)
+    while True:
+        try:
+            _, stderr = process.communicate(timeout=None if cancel is None else 0.2)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel.is_set():
+                process.kill()
+                process.communicate()
+                raise FinalizeCancelled("ffmpeg was cancelled")
+    
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode(errors="replace").strip() or
+                           f"ffmpeg exited with code {process.returncode}")
+
+
+class FFmpegVideoWriter:
+    """Pipe raw BGR frames into an ffmpeg subprocess
+    
+    Provides the parts of cv2.VideoWriter the recorder uses: write, release and isOpened.
+    """
+    
+    # Software encoders that need no GPU or driver support
+    CODECS = ("libx264", "libx265", "mpeg4")
+    PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow")
+    
+    def __init__(self, path, fps, size, codec="libx264", preset="veryfast", crf=23, threads=0,
+                 gop=None, container=None):
+        if codec not in self.CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        if preset not in self.PRESETS:
+            raise ValueError(f"Unknown preset: {preset}")
+        
+        ffmpeg = get_ffmpeg_exe()
+        if not ffmpeg:
+            raise RuntimeError("ffmpeg not found")
+        
+        width, height = size
+        self.path = path
+        self.frame_bytes = width * height * 3
+        
+        cmd = [
+            ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}",
+            "-r", str(fps), "-i", "-",
+            "-an", "-c:v", codec,
+        ]
+        if codec == "mpeg4":
+            # mpeg4 has no presets; map CRF onto its 1-31 quantiser scale
+            cmd += ["-q:v", str(max(1, min(31, int(crf) // 2)))]
+        else:
+            cmd += ["-preset", preset, "-crf", str(crf)]
+        if codec == "libx265" and container is None:
+            cmd += ["-tag:v", "hvc1"]
+        if gop:
+            cmd += ["-g", str(gop)]
+        if container:
+            cmd += ["-f", container]
+        cmd += ["-threads", str(threads), "-pix_fmt", "yuv420p", path]
+        
+        # A path of "-" sends the encoded stream to stdout for the caller to read
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE if path == "-" else subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE, creationflags=_NO_WINDOW)
+        
+        # Drain stderr on a thread so a chatty ffmpeg can never block the pipe
+        self._errors = deque(maxlen=20)
+        self._stderr_thread = threading.Thread(target=self._read_errors, daemon=True)
+        self._stderr_thread.start()
+    
+    def _read_errors(self):
+        for line in self._process.stderr:
+            self._errors.append(line.decode(errors="replace").rstrip())
+    
+    def error_output(self):
+        """Return the last lines ffmpeg wrote to stderr"""
+        return "\n".join(self._errors)
+    
+    def isOpened(self):
+        return self._process is not None and self._process.poll() is None
+    
+    def write(self, frame):
+        """Send one BGR frame to the encoder"""
+        if frame.nbytes != self.frame_bytes:
+            raise ValueError(f"Frame has {frame.nbytes} bytes, expected {self.frame_bytes}")
+        try:
+            self._process.stdin.write(np.ascontiguousarray(frame).data)
+        except (BrokenPipeError, OSError) as e:
+            raise RuntimeError(f"ffmpeg encoder stopped: {self.error_output() or e}")
+    
+    def release(self):
+        """Close the pipe and wait for ffmpeg to finish the file"""
+        if self._process is None:
+            return
+        
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        process.wait()
+        self._stderr_thread.join(timeout=1)
+        
+        if process.returncode != 0:
+            print(f"ffmpeg encoder error: {self.error_output() or process.returncode}")
+
+
+class SplitVideoWriter:
+    """Write each tile of a composite frame to its own video writer
+    
+    Every output gets the same frame at the same time, so the files share one clock.
+    """
+    
+    def __init__(self, writers, tiles):
+        self.writers = writers
+        self.tiles = tiles
+    
+    def isOpened(self):
+        return all(writer.isOpened() for writer in self.writers)
+    
+    def write(self, frame):
+        for writer, (x, y, width, height) in zip(self.writers, self.tiles):
+            writer.write(np.ascontiguousarray(frame[y:y + height, x:x + width]))
+    
+    def release(self):
+        for writer in self.writers:
+            writer.release()
+
+
+class ReplayBufferWriter(FFmpegVideoWriter):
+    """Encode into an in-memory ring of FLV keyframe groups instead of a file
+    
+    ffmpeg writes an FLV stream to stdout with a keyframe every gop_seconds. FLV tags
+    carry each packet's timestamp and keyframe flag in a fixed header, so the stream
+    is cut into groups at every keyframe. Whole groups are evicted from the front once
+    the buffer holds more than seconds of video or max_megabytes, so a snapshot always
+    starts on a keyframe.
+    """
+    
+    # FLV has no mapping for MPEG-4 Part 2
+    CODECS = ("libx264", "libx265")
+    FLV_HEADER = 13
+    TAG_HEADER = 11
+    
+    def __init__(self, fps, size, seconds=30.0, max_megabytes=256, gop_seconds=1.0, **options):
+        self.seconds = seconds
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+        
+        # File header, metadata and decoder configuration, needed to play any group
+        self._header = bytearray()
+        self._groups = deque()
+        self._group_bytes = 0
+        self._current = None
+        self._current_time = None
+        self._base_time = None
+        self._lock = threading.Lock()
+        
+        super().__init__("-", fps, size, gop=max(1, int(round(gop_seconds * fps))),
+                         container="flv", **options)
+        self._reader_thread = threading.Thread(target=self._read_stream,
+                                               args=(self._process.stdout,), daemon=True)
+        self._reader_thread.start()
+    
+    def _read_stream(self, stream):
+        """Split ffmpeg's output into FLV tags as it arrives"""
+        pending = b""
+        need_header = True
+        while True:
+            data = stream.read1(65536)
+            if not data:
+                break
+            pending += data
+            
+            with self._lock:
+                if need_header:
+                    if len(pending) < self.FLV_HEADER:
+                        continue
+                    self._header += pending[:self.FLV_HEADER]
+                    pending = pending[self.FLV_HEADER:]
+                    need_header = False
+                
+                # Each tag is an 11-byte header, its body and a 4-byte back pointer
+                offset = 0
+                while len(pending) - offset >= self.TAG_HEADER:
+                    body_size = int.from_bytes(pending[offset + 1:offset + 4], "big")
+                    end = offset + self.TAG_HEADER + body_size + 4
+                    if end > len(pending):
+                        break
+                    self._add_tag(pending[offset:end])
+                    offset = end
+                pending = pending[offset:]
+        
+        with self._lock:
+            self._finish_group()
+    
+    def _add_tag(self, tag):
+        tag_type = tag[0]
+        timestamp = (int.from_bytes(tag[4:7], "big") | tag[7] << 24) / 1000
+        
+        if tag_type == 9 and len(tag) > self.TAG_HEADER + 1:
+            flags = tag[self.TAG_HEADER]
+            if flags & 0x80:
+                # Enhanced FLV (HEVC): frame type and packet type share the first byte
+                frame_type = (flags >> 4) & 0x07
+                config = (flags & 0x0F) == 0
+                end_of_sequence = (flags & 0x0F) == 2
+            else:
+                frame_type = flags >> 4
+                packet_type = tag[self.TAG_HEADER + 1]
+                config = packet_type == 0
+                end_of_sequence = packet_type == 2
+            
+            if config:
+                self._header += tag
+                return
+            if end_of_sequence:
+                return
+            if frame_type == 1:
+                self._finish_group(timestamp)
+                self._current = bytearray()
+                self._current_time = timestamp
+                if self._base_time is None:
+                    self._base_time = timestamp
+        
+        if self._current is None:
+            # Metadata, or packets before the first keyframe
+            if tag_type == 18:
+                self._header += tag
+            return
+        self._current += tag
+    
+    def _finish_group(self, end_time=None):
+        """Move the group being filled into the ring and evict groups that fell out of it
+        
+        end_time is when the group ends, i.e. the timestamp of the next keyframe.
+        """
+        if not self._current:
+            return
+        group = (self._current_time, bytes(self._current))
+        self._current = None
+        self._groups.append(group)
+        self._group_bytes += len(group[1])
+        
+        # Drop the oldest group while the rest still cover the requested duration
+        if end_time is None:
+            end_time = group[0]
+        while len(self._groups) > 1:
+            too_old = end_time - self._groups[1][0] >= self.seconds
+            if not too_old and self._group_bytes <= self.max_bytes:
+                break
+            _, oldest = self._groups.popleft()
+            self._group_bytes -= len(oldest)
+    
+    def buffered_bytes(self):
+        with self._lock:
+            return self._group_bytes + len(self._current or b"")
+    
+    def snapshot(self):
+        """Return the buffered stream and its start time in seconds from the first frame
+        
+        Includes the group still being filled, so the most recent frames are kept.
+        """
+        with self._lock:
+            groups = list(self._groups)
+            if self._current:
+                groups.append((self._current_time, bytes(self._current)))
+            if not groups:
+                return None, 0.0
+            header = bytes(self._header)
+            start = groups[0][0] - self._base_time
+        return header + b"".join(data for _, data in groups), start
+    
+    def release(self):
+        """Stop the encoder and wait for its remaining output to be buffered"""
+        super().release()
+        self._reader_thread.join(timeout=5)
+
+
+def create_video_writer(path, fps, size, encoder="auto", **options):
+    """Open a video writer: "ffmpeg" pipes to ffmpeg, "opencv" uses cv2.VideoWriter with mp4v
+    
+    "auto" uses ffmpeg when a binary can be found. The ffmpeg options (codec, preset,
+    crf, threads) are ignored by the OpenCV writer.
+    """
+    if encoder == "auto":
+        encoder = "ffmpeg" if get_ffmpeg_exe() else "opencv"
+    
+    if encoder == "ffmpeg":
+        return FFmpegVideoWriter(path, fps, size, **options)
+    if encoder == "opencv":
+        fourcc = cv2.VideoWriter.fourcc(*'mp4v')
+        return cv2.VideoWriter(path, fourcc, fps, size)
+    raise ValueError(f"Unknown video encoder: {encoder}")
+
+
+class RecordingSegment:
+    """One closed piece of a segmented recording"""
+    
+    def __init__(self, index, path, start_time, duration, writer=None, size=None):
+        self.index = index
+        self.path = path
+        self.size = size
+        # Position and length of the segment in the recording, in seconds
+        self.start_time = start_time
+        self.duration = duration
+        self.writer = writer
+
+
+class SegmentedVideoWriter:
+    """Video writer that rotates to a new file every N seconds or N megabytes
+    
+    Full segments are closed on a background thread, passed to finalize_segment (for
+    example to mux their audio) and listed in an ffconcat manifest, so a crash loses at
+    most the segment being written and stopping only waits for the last one.
+    """
+    
+    def __init__(self, path, fps, open_writer, segment_seconds=None, segment_megabytes=None,
+                 finalize_segment=None, frame_size=None):
+        if not segment_seconds and not segment_megabytes:
+            raise ValueError("Segmented recording needs a segment length or size")
+        
+        self.fps = fps
+        self.open_writer = open_writer
+        self.segment_frames = max(1, int(round(segment_seconds * fps))) if segment_seconds else None
+        self.segment_bytes = int(segment_megabytes * 1024 * 1024) if segment_megabytes else None
+        self.finalize_segment = finalize_segment
+        
+        # Frame size of new segments; changing it starts a new segment at the next frame,
+        # and frames of the old size still in flight are scaled to it
+        self.frame_size = tuple(frame_size) if frame_size else None
+        self._segment_size = self.frame_size
+        self._reopen = False
+        
+        base_name = os.path.splitext(path)[0]
+        self.path_pattern = base_name + "_part{:03d}.mp4"
+        self.manifest_path = base_name + ".ffconcat"
+        
+        # Finished segments, in order, once closed and finalized
+        self.segments = []
+        self.frames_written = 0
+        self._segment_start = 0
+        self._index = 0
+        self._current = None
+        self._current_path = None
+        
+        self._closing = queue.Queue()
+        self._finalizer_thread = threading.Thread(target=self._finalize_loop, daemon=True)
+        self._finalizer_thread.start()
+        
+        # Open the first segment now so a failing encoder is reported before recording starts
+        self._open_segment()
+    
+    def isOpened(self):
+        return self._current is not None and self._current.isOpened()
+    
+    def _open_segment(self):
+        self._index += 1
+        self._current_path = self.path_pattern.format(self._index)
+        self._segment_start = self.frames_written
+        self._segment_size = self.frame_size
+        self._reopen = False
+        self._current = self.open_writer(self._current_path)
+    
+    def reopen(self):
+        """Start a new segment at the next frame, e.g. so new encoder settings take effect"""
+        self._reopen = True
+    
+    def _segment_full(self):
+        frames = self.frames_written - self._segment_start
+        if self.segment_frames and frames >= self.segment_frames:
+            return True
+        if self.segment_bytes:
+            try:
+                return os.path.getsize(self._current_path) >= self.segment_bytes
+            except OSError:
+                return False
+        return False
+    
+    def _close_segment(self):
+        """Hand the current segment to the finalizer thread"""
+        frames = self.frames_written - self._segment_start
+        segment = RecordingSegment(self._index, self._current_path, self._segment_start / self.fps,
+                                   frames / self.fps, self._current, self._segment_size)
+        self._current = None
+        if frames:
+            self._closing.put(segment)
+        else:
+            # Nothing was written: drop the empty file instead of listing it
+            segment.writer.release()
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+    
+    def write(self, frame):
+        """Write one frame, starting a new segment first if the current one is full"""
+        frame_size = self.frame_size
+        if frame_size and frame.shape[1::-1] != frame_size:
+            frame = cv2.resize(frame, frame_size, interpolation=cv2.INTER_AREA)
+        
+        if self._current is None:
+            self._open_segment()
+        elif self._reopen or self._segment_size != frame_size or self._segment_full():
+            self._close_segment()
+            self._open_segment()
+        self._current.write(frame)
+        self.frames_written += 1
+    
+    def release(self):
+        """Close the last segment and wait until every segment has been finalized"""
+        if self._current is not None:
+            self._close_segment()
+        if self._finalizer_thread is not None:
+            self._closing.put(_STOP)
+            self._finalizer_thread.join()
+            self._finalizer_thread = None
+    
+    def _finalize_loop(self):
+        while True:
+            segment = self._closing.get()
+            if segment is _STOP:
+                return
+            
+            try:
+                # Waits for the encoder to finish writing the file
+                segment.writer.release()
+                segment.writer = None
+                if self.finalize_segment:
+                    self.finalize_segment(segment)
+            except Exception as e:
+                print(f"Segment {segment.index} finalize error: {e}")
+            
+            self.segments.append(segment)
+            self._write_manifest()
+    
+    def _write_manifest(self):
+        """Rewrite the concat manifest atomically so it always lists complete segments"""
+        lines = ["ffconcat version 1.0"]
+        for segment in self.segments:
+            name = os.path.basename(segment.path).replace("'", "'\\''")
+            lines.append(f"file '{name}'")
+            lines.append(f"duration {segment.duration:.6f}")
+        
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.manifest_path)
+
+
+class MJPEGStreamServer:
+    """Serve the recording live as MJPEG over HTTP while it is written to disk
+    
+    The asyncio server runs on its own thread. offer() is called from the encode stage
+    with every output frame; at most fps frames a second are copied out and JPEG-encoded
+    once on a separate thread, then handed to each viewer's bounded queue. A viewer that
+    reads too slowly has its oldest queued frame dropped, so it can never hold up capture
+    or the other viewers. Open http://host:port/ in a browser, or read /stream.mjpg or
+    /snapshot.jpg with any HTTP client.
+    """
+    
+    BOUNDARY = b"frame"
+    
+    def __init__(self, host="127.0.0.1", port=8080, fps=10.0, quality=70, max_width=1280,
+                 client_queue_size=2):
+        self.host = host
+        self.port = port
+        self.interval = 1.0 / fps if fps else 0.0
+        self.quality = quality
+        self.max_width = max_width
+        self.client_queue_size = client_queue_size
+        
+        self.frames_encoded = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.clients_served = 0
+        self.latest_jpeg = None
+        
+        self._loop = None
+        self._server = None
+        self._server_thread = None
+        self._encode_thread = None
+        self._start_error = None
+        self._clients = set()
+        self._running = False
+        self._next_frame_at = 0.0
+        
+        # Two frame buffers: offer() copies into one while the other is being encoded
+        self._buffers = [None, None]
+        self._encoding = 0
+        self._pending = None
+        self._ready = threading.Condition()
+    
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/"
+    
+    def start(self):
+        """Bind the server socket and start serving; raises if the port cannot be used"""
+        self._running = True
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self._server_thread = threading.Thread(target=self._serve, args=(started,), daemon=True)
+        self._server_thread.start()
+        started.wait()
+        if self._start_error is not None:
+            self._running = False
+            self._server_thread.join()
+            self._server_thread = None
+            raise self._start_error
+        
+        self._encode_thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self._encode_thread.start()
+    
+    def stop(self):
+        """Disconnect every viewer and shut the server down"""
+        with self._ready:
+            self._running = False
+            self._ready.notify()
+        if self._encode_thread:
+            self._encode_thread.join()
+            self._encode_thread = None
+        if self._server_thread:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._server_thread.join()
+            self._server_thread = None
+    
+    def stats(self):
+        return {
+            "url": self.url,
+            "clients": len(self._clients),
+            "clients_served": self.clients_served,
+            "frames_encoded": self.frames_encoded,
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+        }
+    
+    def offer(self, frame):
+        """Take a copy of frame if a viewer is connected and the next stream frame is due"""
+        if not self._clients:
+            return
+        now = time.monotonic()
+        if now < self._next_frame_at:
+            return
+        self._next_frame_at = now + self.interval
+        
+        with self._ready:
+            index = 1 - self._encoding
+            buffer = self._buffers[index]
+            if buffer is None or buffer.shape != frame.shape:
+                buffer = self._buffers[index] = np.empty_like(frame)
+            np.copyto(buffer, frame)
+            # A frame still waiting here is simply replaced by the newer one
+            self._pending = index
+            self._ready.notify()
+    
+    def _encode_loop(self):
+        """JPEG-encode the latest offered frame once and publish it to every viewer"""
+        while True:
+            with self._ready:
+                while self._running and self._pending is None:
+                    self._ready.wait()
+                if not self._running:
+                    return
+                self._encoding = self._pending
+                self._pending = None
+            
+            frame = self._buffers[self._encoding]
+            if self.max_width and frame.shape[1] > self.max_width:
+                height = int(frame.shape[0] * self.max_width / frame.shape[1]) // 2 * 2
+                frame = cv2.resize(frame, (self.max_width, height), interpolation=cv2.INTER_AREA)
+            ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok:
+                continue
+            self.frames_encoded += 1
+            self.latest_jpeg = jpeg.tobytes()
+            try:
+                self._loop.call_soon_threadsafe(self._publish, self.latest_jpeg)
+            except RuntimeError:
+                # The event loop has already been closed
+                return
+    
+    def _publish(self, jpeg):
+        """Queue a frame for every viewer, dropping each slow viewer's oldest frame"""
+        for frames in self._clients:
+            if frames.full():
+                frames.get_nowait()
+                self.frames_dropped += 1
+            frames.put_nowait(jpeg)
+    
+    def _serve(self, started):
+        """Run the asyncio event loop until stop()"""
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_client, self.host, self.port))
+            # Port 0 asks the OS for a free port
+            self.port = self._server.sockets[0].getsockname()[1]
+        except Exception as e:
+            self._start_error = e
+            self._loop.close()
+            started.set()
+            return
+        
+        started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            # Cancel the viewer connections before closing the listening socket
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+    
+    async def _handle_client(self, reader, writer):
+        """Answer one HTTP request: the viewer page, the MJPEG stream or a snapshot"""
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=10)
+            parts = request.split(b" ", 2)
+            path = parts[1].decode("latin-1").split("?", 1)[0] if len(parts) > 1 else "/"
+            
+            if path == "/stream.mjpg":
+                await self._stream(writer)
+            elif path == "/snapshot.jpg" and self.latest_jpeg is not None:
+                await self._respond(writer, b"200 OK", b"image/jpeg", self.latest_jpeg)
+            elif path == "/snapshot.jpg":
+                await self._respond(writer, b"503 Service Unavailable", b"text/plain",
+                                    b"No frame has been streamed yet\n")
+            elif path == "/":
+                page = b"<!DOCTYPE html><title>Screen Recorder</title>" \
+                       b"<body style=\"margin:0;background:#000\">" \
+                       b"<img src=\"/stream.mjpg\" style=\"width:100%\"></body>"
+                await self._respond(writer, b"200 OK", b"text/html", page)
+            else:
+                await self._respond(writer, b"404 Not Found", b"text/plain", b"Not found\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                asyncio.CancelledError, ConnectionError):
+            # Viewers that disconnect, and those cut off when the server stops, end quietly
+            pass
+        finally:
+            writer.close()
+    
+    async def _respond(self, writer, status, content_type, body):
+        writer.write(b"HTTP/1.0 " + status + b"\r\nContent-Type: " + content_type
+                     + b"\r\nContent-Length: " + str(len(body)).encode()
+                     + b"\r\nCache-Control: no-cache\r\n\r\n" + body)
+        await writer.drain()
+    
+    async def _stream(self, writer):
+        """Send frames to one viewer until it disconnects"""
+        frames = asyncio.Queue(maxsize=self.client_queue_size)
+        self._clients.add(frames)
+        self.clients_served += 1
+        try:
+            writer.write(b"HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\n"
+                         b"Content-Type: multipart/x-mixed-replace; boundary=" + self.BOUNDARY
+                         + b"\r\n\r\n")
+            while True:
+                jpeg = await frames.get()
+                writer.write(b"--" + self.BOUNDARY + b"\r\nContent-Type: image/jpeg\r\n"
+                             b"Content-Length: " + str(len(jpeg)).encode() + b"\r\n\r\n"
+                             + jpeg + b"\r\n")
+                await writer.drain()
+                self.frames_sent += 1
+        finally:
+            self._clients.discard(frames)
+
+
+# Rough speed of the MoviePy libx264 re-encode relative to real time at 1080p; only
+# used to estimate how much time a stream-copy remux saved
+MOVIEPY_REENCODE_SPEED = 1.0
+
+
+def probe_duration(path):
+    """Return a media file's duration in seconds from its container header, or None"""
+    ffmpeg = get_ffmpeg_exe()
+    if not ffmpeg:
+        return None
+    
+    # ffmpeg prints "Duration: HH:MM:SS.ss" for each input without decoding anything
+    result = subprocess.run([ffmpeg, "-hide_banner", "-i", path], stdin=subprocess.DEVNULL,
+                            capture_output=True, creationflags=_NO_WINDOW)
+    for line in result.stderr.decode(errors="replace").splitlines():
+        line = line.strip()
+        if line.startswith("Duration:"):
+            stamp = line.split(",")[0].split()[1]
+            try:
+                hours, minutes, seconds = stamp.split(":")
+                return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            except ValueError:
+                return None
+    return None
+
+
+def remux_audio_video(video_file, audio_file, output_file, audio_offset=0.0, duration=None,
+                      audio_input_options=(), cancel=None):
+    """Attach an audio track by copying the video stream; only the audio is encoded
+    
+    audio_offset is how many seconds after the first video frame the audio started.
+    duration trims the output by timestamp at the container level, without decoding.
+    audio_input_options describe audio files without a header, such as raw PCM.
+    cancel is passed on to run_ffmpeg.
+    """
+    args = ["-i", video_file]
+    if audio_offset > 0:
+        args += ["-itsoffset", f"{audio_offset:.6f}"]
+    elif audio_offset < 0:
+        args += ["-ss", f"{-audio_offset:.6f}"]
+    args += [
+        *audio_input_options,
+        "-i", audio_file,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-c:v", "copy", "-c:a", "aac", "-b:a", "192k",
+    ]
+    args += ["-t", f"{duration:.6f}"] if duration else ["-shortest"]
+    args.append(output_file)
+    run_ffmpeg(args, cancel)
+
+
+def concat_segments(manifest_path, output_file, cancel=None):
+    """Join the segments listed in an ffconcat manifest without re-encoding"""
+    run_ffmpeg(["-f", "concat", "-safe", "0", "-i", manifest_path, "-c", "copy",
+                "-movflags", "+faststart", output_file], cancel)
+
+
+def unique_path(path, taken=()):
+    """path, or path with a counter added if that file already exists or is in taken
+    
+    Recordings started within the same second would otherwise share a timestamped
+    name while the earlier one is still being finished. taken holds names already
+    claimed by writes that have not created their files yet.
+    """
+    base_name, extension = os.path.splitext(path)
+    candidate = path
+    counter = 2
+    while os.path.exists(candidate) or candidate in taken:
+        candidate = f"{base_name}_{counter}{extension}"
+        counter += 1
+    return candidate
+
+
+def process_alive(pid):
+    """Whether a process with this id is still running"""
+    if pid == os.getpid():
+        return True
+    if sys.platform == "win32":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION; fails if there is no such process
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class TempFileJournal:
+    """On-disk list of a recording's temporary files, so a crash cannot leave them behind
+    
+    Every temporary file is added before it is created and discarded once it has been
+    used, or kept if it ends up as an output (audio that could not be merged). The
+    streamed audio track is listed separately with add_track: after a crash it is the
+    only copy of the sound, so it is recovered rather than deleted. The journal is
+    written atomically whenever the lists change and deleted when the recording is
+    finished; clean_up_stale handles the journals whose process is gone.
+    """
+    
+    SUFFIX = ".tmpfiles.json"
+    
+    def __init__(self, path):
+        self.path = path
+        self.files = set()
+        self.tracks = {}
+        self._lock = threading.Lock()
+    
+    def add(self, path):
+        """Record a temporary file before it is created"""
+        with self._lock:
+            self.files.add(os.path.abspath(path))
+            self._write()
+    
+    def add_track(self, path, video, file_format, channels, sample_width, rate):
+        """Record the audio track being streamed to path for the recording in video
+        
+        video may be None when there is no single file to attach the audio to.
+        """
+        with self._lock:
+            self.tracks[os.path.abspath(path)] = {
+                "path": os.path.abspath(path),
+                "video": os.path.abspath(video) if video else None,
+                "format": file_format,
+                "channels": channels,
+                "sample_width": sample_width,
+                "rate": rate,
+            }
+            self._write()
+    
+    def discard(self, path):
+        """Delete a temporary file if it still exists and forget it"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self.keep(path)
+    
+    def keep(self, path):
+        """Forget a file without deleting it, because it is now an output"""
+        with self._lock:
+            self.files.discard(os.path.abspath(path))
+            self.tracks.pop(os.path.abspath(path), None)
+            self._write()
+    
+    def close(self):
+        """Delete the journal; files still listed are left as they are"""
+        with self._lock:
+            self.files.clear()
+            self.tracks.clear()
+            self._write()
+    
+    def _write(self):
+        if not self.files and not self.tracks:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            return
+        
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"pid": os.getpid(), "files": sorted(self.files),
+                       "tracks": list(self.tracks.values())}, f)
+        os.replace(temp_path, self.path)
+    
+    @classmethod
+    def clean_up_stale(cls, directory="."):
+        """Clear up after recordings in directory that crashed
+        
+        Intermediate files are deleted. Each audio track is muxed into its recording if
+        ffmpeg can read both, and otherwise kept as a playable WAV. Returns a dict with
+        the paths "removed" and a "recovered" list of dicts giving each track's "video",
+        the "audio" file kept (None once merged) and whether it was "merged".
+        """
+        report = {"removed": [], "recovered": []}
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return report
+        
+        for name in names:
+            if not name.endswith(cls.SUFFIX):
+                continue
+            journal_path = os.path.join(directory, name)
+            try:
+                with open(journal_path) as f:
+                    journal = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if process_alive(journal.get("pid", 0)):
+                continue
+            
+            for path in journal.get("files", []):
+                try:
+                    os.remove(path)
+                    report["removed"].append(path)
+                except OSError:
+                    pass
+            for track in journal.get("tracks", []):
+                recovered = recover_audio_track(track)
+                if recovered:
+                    report["recovered"].append(recovered)
+            try:
+                os.remove(journal_path)
+            except OSError:
+                pass
+        return report
+
+
+def repair_wav_header(path):
+    """Fix the sizes in a WAV header left unfinished by a crash
+    
+    Only handles the plain 44-byte header Python's wave module writes. Returns False
+    if the file is not one.
+    """
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        header = f.read(44)
+        if len(header) < 44 or header[:4] != b"RIFF" or header[36:40] != b"data":
+            return False
+        block_align = int.from_bytes(header[32:34], "little") or 1
+        data_size = (size - 44) // block_align * block_align
+        f.seek(4)
+        f.write((36 + data_size).to_bytes(4, "little"))
+        f.seek(40)
+        f.write(data_size.to_bytes(4, "little"))
+    return True
+
+
+def recover_audio_track(track):
+    """Save the audio of a crashed recording; see TempFileJournal.clean_up_stale"""
+    path = track["path"]
+    try:
+        if os.path.getsize(path) <= 44:
+            os.remove(path)  # Nothing was recorded
+            return None
+    except OSError:
+        return None
+    
+    # Make the track playable on its own first; raw PCM has no header at all
+    if track["format"] == "pcm":
+        wav_path = unique_path(os.path.splitext(path)[0] + ".wav")
+        frame_size = track["channels"] * track["sample_width"]
+        with open(path, "rb") as src, wave.open(wav_path, "wb") as dst:
+            dst.setnchannels(track["channels"])
+            dst.setsampwidth(track["sample_width"])
+            dst.setframerate(track["rate"])
+            remainder = b""
+            while True:
+                block = src.read(1024 * 1024)
+                if not block:
+                    break
+                block = remainder + block
+                usable = len(block) // frame_size * frame_size
+                dst.writeframesraw(block[:usable])
+                remainder = block[usable:]
+        os.remove(path)
+        path = wav_path
+    elif track["format"] == "wav":
+        repair_wav_header(path)
+    
+    video = track.get("video")
+    if video and os.path.exists(video) and get_ffmpeg_exe():
+        # The start offset died with the recorder; the tracks started within a frame or two
+        muxed_file = os.path.splitext(video)[0] + "_with_audio.mp4"
+        try:
+            remux_audio_video(video, path, muxed_file)
+            os.replace(muxed_file, video)
+            os.remove(path)
+            return {"video": video, "audio": None, "merged": True}
+        except Exception as e:
+            print(f"Could not attach the recovered audio to {video}: {e}")
+            try:
+                os.remove(muxed_file)
+            except OSError:
+                pass
+    return {"video": video, "audio": path, "merged": False}
+
+
+def describe_recovery(report):
+    """One line per recovered audio track, for telling the user after a crash"""
+    lines = []
+    for track in report["recovered"]:
+        if track["merged"]:
+            lines.append(f"Audio recovered into {track['video']}")
+        elif track["video"]:
+            lines.append(f"Audio for {track['video']} kept in {track['audio']}")
+        else:
+            lines.append(f"Audio kept in {track['audio']}")
+    return lines
+
+
+# Resolution presets, shared by the GUI and the command line
+RESOLUTION_OPTIONS = {
+    "HD (720p)": (1280, 720),
+    "Full HD (1080p)": (1920, 1080),
+    "4K (2160p)": (3840, 2160)
+}
+
+# Audio inputs the engine can record from
+AUDIO_SOURCES = ("none", "system_mic", "external_mic")
+
+# Ways to record every monitor at once; None records the configured region only
+MULTI_MONITOR_MODES = (None, "composite", "separate")
+
+# Default settings for the ffmpeg pipe encoder
+DEFAULT_ENCODER_OPTIONS = {
+    "codec": "libx264",
+    "preset": "veryfast",
+    "crf": 23,
+    "threads": 0
+}
+
+
+class RecordingConfig:
+    """Settings for one recording, fixed when the recording starts"""
+    
+    def __init__(self, output_filename=None, resolution=(1920, 1080), fps=30.0, region=None,
+                 capture_backend="auto", capture_options=None, audio_source="none", audio_rate=44100, audio_chunk=1024,
+                 audio_file_format="wav", audio_buffer_seconds=2.0, video_encoder="auto",
+                 encoder_options=None, merge_mode="remux", skip_unchanged_frames=True,
+                 pipeline_workers=None, pipeline_queue_size=8, frame_drop_policy="drop_oldest",
+                 metrics_interval=1.0, segment_seconds=None, segment_megabytes=None,
+                 stitch_segments=False, replay_seconds=None, replay_max_megabytes=256,
+                 multi_monitor=None, stream_port=None, stream_host="127.0.0.1", stream_fps=10.0,
+                 adaptive_quality=False):
+        if audio_source not in AUDIO_SOURCES:
+            raise ValueError(f"Unknown audio source: {audio_source}")
+        if multi_monitor not in MULTI_MONITOR_MODES:
+            raise ValueError(f"Unknown multi-monitor mode: {multi_monitor}")
+        if multi_monitor == "separate" and (segment_seconds or segment_megabytes or replay_seconds):
+            raise ValueError("Separate monitor files cannot be combined with segments or replay")
+        if replay_seconds and (segment_seconds or segment_megabytes or stitch_segments):
+            raise ValueError("The replay buffer cannot be combined with segments or stitching")
+        
+        # Output file; a timestamped name is generated when this is None
+        self.output_filename = output_filename
+        
+        # Video settings
+        self.resolution = tuple(resolution)
+        self.fps = float(fps)
+        self.region = region or CaptureRegion()
+        # Record every monitor: "composite" side by side in one file, "separate" one file each
+        self.multi_monitor = multi_monitor
+        self.capture_backend = capture_backend
+        self.capture_options = dict(capture_options or {})
+        self.video_encoder = video_encoder
+        self.encoder_options = dict(DEFAULT_ENCODER_OPTIONS, **(encoder_options or {}))
+        self.skip_unchanged_frames = skip_unchanged_frames
+        
+        # Pipeline settings
+        self.pipeline_workers = pipeline_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.pipeline_queue_size = pipeline_queue_size
+        self.frame_drop_policy = frame_drop_policy
+        
+        # Audio settings
+        self.audio_source = audio_source
+        self.audio_rate = audio_rate
+        self.audio_chunk = audio_chunk
+        self.audio_file_format = audio_file_format
+        self.audio_buffer_seconds = audio_buffer_seconds
+        
+        # Audio merge: "remux" copies the video stream with ffmpeg, "reencode" uses moviepy
+        self.merge_mode = merge_mode
+        
+        # Seconds between snapshots passed to metrics sinks
+        self.metrics_interval = metrics_interval
+        
+        # Segmented recording: rotate files every N seconds and/or N MB, and optionally
+        # join the segments into output_filename without re-encoding when recording stops
+        self.segment_seconds = segment_seconds
+        self.segment_megabytes = segment_megabytes
+        self.stitch_segments = stitch_segments
+        
+        # Replay buffer: keep only the last N seconds in memory and save them on demand
+        self.replay_seconds = replay_seconds
+        self.replay_max_megabytes = replay_max_megabytes
+        
+        # Live MJPEG stream served over HTTP alongside the file; None disables it
+        self.stream_port = stream_port
+        self.stream_host = stream_host
+        self.stream_fps = stream_fps
+        
+        # Step resolution, encoder preset and capture frame rate down when capture cannot
+        # keep up, and back up once it can; resolution and preset only change between
+        # segments, so single-file recordings only adapt the frame rate
+        self.adaptive_quality = adaptive_quality
+    
+    @property
+    def segmented(self):
+        return bool(self.segment_seconds or self.segment_megabytes)
+
+
+def format_metrics(snapshot):
+    """One-line summary of a metrics snapshot, for a log or status line"""
+    parts = [f"{snapshot['elapsed']:.1f}s"]
+    
+    video = snapshot.get("video")
+    if video:
+        parts.append(f"{video['capture_fps']:.1f}/{video['capture_target_fps']:g} fps, "
+                     f"{video['dropped_frames']} dropped, {video['duplicated_frames']} repeated, "
+                     f"queues {video['convert_queue']}+{video['encode_queue']}/{video['queue_size']}")
+    
+    audio = snapshot.get("audio")
+    if audio:
+        parts.append(f"audio {audio['overflows']} overflows, {audio['dropped_samples']} samples dropped, "
+                     f"{audio.get('buffer_fill', 0.0):.0%} buffered")
+    
+    quality = snapshot.get("quality")
+    if quality:
+        parts.append(f"quality {quality['setting']}")
+    
+    stream = snapshot.get("stream")
+    if stream:
+        parts.append(f"stream {stream['clients']} viewers, {stream['frames_dropped']} frames dropped")
+    return "; ".join(parts)
+
+
+class MetricsJsonLinesWriter:
+    """Metrics sink that appends each snapshot to a JSON-lines file"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+    
+    def __call__(self, snapshot):
+        with self._lock:
+            self._file.write(json.dumps(snapshot) + "\n")
+            self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class QualityLevel:
+    """One step of the adaptive quality ladder"""
+    
+    def __init__(self, output_size, fps, capture_stride=1, preset=None):
+        self.output_size = tuple(output_size)
+        # Frames captured per second; the file keeps its frame rate by repeating frames
+        self.fps = fps / capture_stride
+        self.capture_stride = capture_stride
+        self.preset = preset
+    
+    def __str__(self):
+        text = f"{self.output_size[0]}x{self.output_size[1]} at {self.fps:g} fps"
+        if self.preset:
+            text += f", {self.preset} preset"
+        return text
+
+
+def quality_levels(output_size, fps, preset=None, resizable=False, min_fps=10.0):
+    """Ladder of quality levels from the starting settings down to the cheapest
+    
+    Resolution goes first, through the smaller RESOLUTION_OPTIONS sizes, then the
+    encoder preset, then the capture frame rate, so motion stays smooth for as long as
+    possible. Resolution and preset changes need a new encoder, so they are only used
+    when resizable is set (segmented recordings, where each change starts a segment).
+    """
+    levels = [QualityLevel(output_size, fps, preset=preset)]
+    
+    if resizable:
+        area = output_size[0] * output_size[1]
+        sizes = {fit_resolution(output_size, option) for option in RESOLUTION_OPTIONS.values()}
+        for size in sorted(sizes, key=lambda size: size[0] * size[1], reverse=True):
+            if size[0] * size[1] < area:
+                levels.append(QualityLevel(size, fps, preset=preset))
+        
+        if preset in FFmpegVideoWriter.PRESETS:
+            for faster in reversed(FFmpegVideoWriter.PRESETS[:FFmpegVideoWriter.PRESETS.index(preset)]):
+                levels.append(QualityLevel(levels[-1].output_size, fps, preset=faster))
+    
+    stride = 2
+    while fps / stride >= min_fps:
+        last = levels[-1]
+        levels.append(QualityLevel(last.output_size, fps, stride, last.preset))
+        stride += 1
+    return levels
+
+
+class AdaptiveQualityController:
+    """Step recording quality down when capture cannot keep up, and back up with headroom
+    
+    Called with a metrics snapshot at every metrics interval. Capture is overloaded when
+    it misses its frame rate by more than 10%, drops frames or fills the pipeline queues;
+    after down_after overloaded snapshots in a row the next level down is applied, or the
+    next lower frame rate if the queues are empty and grabbing the screen itself is the
+    bottleneck, since a smaller output size or faster preset would not help then. Once
+    capture has kept up for up_after seconds the level above is tried again, and each
+    time a level proves too much the wait before retrying it doubles.
+    """
+    
+    def __init__(self, levels, apply_level, down_after=2, up_after=10.0):
+        self.levels = levels
+        self.apply_level = apply_level
+        self.down_after = down_after
+        self.max_wait = up_after * 8
+        self.level = 0
+        # (elapsed seconds, old level, new level, reason) for every change made
+        self.changes = []
+        
+        self._retry_after = [up_after] * len(levels)
+        self._overloaded = 0
+        self._calm_since = None
+        self._last_dropped = None
+    
+    @property
+    def current(self):
+        return self.levels[self.level]
+    
+    def stats(self):
+        return {
+            "level": self.level,
+            "levels": len(self.levels),
+            "setting": str(self.current),
+            "changes": len(self.changes),
+        }
+    
+    def __call__(self, snapshot):
+        video = snapshot.get("video")
+        if not snapshot["recording"] or snapshot["paused"] or not video:
+            self._calm_since = None
+            return
+        
+        # The first snapshot after a change only sets the baseline
+        dropped_total = video["dropped_frames"]
+        if self._last_dropped is None:
+            self._last_dropped = dropped_total
+            return
+        dropped = dropped_total - self._last_dropped
+        self._last_dropped = dropped_total
+        
+        target = video["capture_target_fps"]
+        queued = (video["convert_queue"] + video["encode_queue"]) / (2 * video["queue_size"])
+        reasons = []
+        if video["capture_fps"] < 0.9 * target:
+            reasons.append(f"capturing {video['capture_fps']:.1f} of {target:g} fps")
+        if dropped:
+            reasons.append(f"dropped {dropped} frames")
+        if queued >= 0.75:
+            reasons.append(f"queues {queued:.0%} full")
+        
+        if reasons:
+            self._calm_since = None
+            self._overloaded += 1
+            if self._overloaded >= self.down_after and self.level + 1 < len(self.levels):
+                level = self.level + 1
+                if queued <= 0.25:
+                    stride = self.current.capture_stride
+                    level = next((index for index in range(level, len(self.levels))
+                                  if self.levels[index].capture_stride > stride), level)
+                self._retry_after[self.level] = min(self._retry_after[self.level] * 2, self.max_wait)
+                self._change(level, snapshot["elapsed"], ", ".join(reasons))
+            return
+        
+        self._overloaded = 0
+        if queued > 0.25:
+            return
+        if self._calm_since is None:
+            self._calm_since = snapshot["elapsed"]
+        calm = snapshot["elapsed"] - self._calm_since
+        if self.level > 0 and calm >= self._retry_after[self.level - 1]:
+            self._change(self.level - 1, snapshot["elapsed"], f"kept up for {calm:.0f}s")
+    
+    def _change(self, level, elapsed, reason):
+        old = self.current
+        self.level = level
+        self.changes.append((elapsed, str(old), str(self.current), reason))
+        print(f"Adaptive quality: {old} -> {self.current} ({reason})")
+        self.apply_level(self.current)
+        
+        self._overloaded = 0
+        self._calm_since = None
+        self._last_dropped = None
+
+
+class RecordingEngine:
+    """Screen and audio recorder with no UI: start, pause, resume and stop
+    
+    Front ends poll the engine (elapsed, error, metrics) instead of being called back
+    from the recording threads. on_status, if given, is called with progress messages
+    from whichever thread calls stop() or finalize(). Each metrics sink is called with a metrics()
+    snapshot every config.metrics_interval seconds from a background thread.
+    """
+    
+    def __init__(self, config=None, on_status=None, metrics_sinks=None):
+        self.config = config or RecordingConfig()
+        self.on_status = on_status
+        self.metrics_sinks = list(metrics_sinks or [])
+        self._metrics_thread = None
+        self._metrics_stop = threading.Event()
+        
+        # Recording state variables
+        self.is_recording = False
+        self.is_paused = False
+        self.video_writer = None
+        self.audio_thread = None
+        self.output_filename = None
+        self.temp_audio_file = None
+        self.audio_enabled = False
+        
+        # Audio recording variables
+        self.audio = None
+        self.audio_stream = None
+        self.audio_ring = None
+        self.audio_writer = None
+        self.audio_stats = AudioCaptureStats()
+        self.audio_frame_size = 4
+        self.audio_format = None
+        self.audio_channels = 2
+        self.audio_start_time = None
+        
+        # Video pipeline state
+        self.capture_backend = None
+        self.region_capture = None
+        self.monitor_capture = None
+        self.stream_server = None
+        self.quality_controller = None
+        self.encoder_options = dict(self.config.encoder_options)
+        self.output_files = []
+        self.recording_session = None
+        self.frame_pipeline = None
+        self.change_detector = None
+        
+        self.last_merge_report = None
+        
+        # Post-processing state, read by FinalizeJob while finalize() runs
+        self.journal = None
+        self.finalize_progress = 0.0
+        self._finalize_cancel = threading.Event()
+        
+        # Replays being written in the background, and the files already saved
+        self._replay_threads = []
+        self.saved_replays = []
+        # Output and temporary files claimed by replay saves still in progress
+        self._replay_files = set()
+        self._replay_lock = threading.Lock()
+    
+    @property
+    def audio_rate(self):
+        return self.config.audio_rate
+    
+    @property
+    def audio_chunk(self):
+        return self.config.audio_chunk
+    
+    @property
+    def error(self):
+        """The error that stopped video capture, if any"""
+        return self.frame_pipeline.error if self.frame_pipeline else None
+    
+    def _status(self, message):
+        if self.on_status:
+            self.on_status(message)
+    
+    def elapsed(self):
+        """Seconds recorded so far, not counting pauses"""
+        if self.frame_pipeline is None:
+            return 0.0
+        return self.frame_pipeline.scheduler.elapsed()
+    
+    def add_metrics_sink(self, sink):
+        """Register a callable that receives a metrics snapshot at every interval"""
+        self.metrics_sinks.append(sink)
+    
+    def metrics(self):
+        """Snapshot of frame rates, frame counters, queue depths, stage latency and audio health"""
+        snapshot = {
+            "timestamp": time.time(),
+            "elapsed": self.elapsed(),
+            "recording": self.is_recording,
+            "paused": self.is_paused,
+            "video": None,
+            "latency": self.latency_stats(),
+            "audio": self.get_audio_stats() if self.audio_enabled else None,
+        }
+        if self.frame_pipeline is not None:
+            snapshot["video"] = self.frame_pipeline.stats()
+            if self.change_detector is not None:
+                snapshot["video"]["dirty_fraction"] = self.change_detector.dirty_fraction
+            if self.monitor_capture is not None:
+                snapshot["video"]["monitor_frames"] = list(self.monitor_capture.frames_grabbed)
+        if self.quality_controller is not None:
+            snapshot["quality"] = self.quality_controller.stats()
+        if self.stream_server is not None:
+            snapshot["stream"] = self.stream_server.stats()
+        return snapshot
+    
+    def emit_metrics(self):
+        """Pass a fresh snapshot to the quality controller and every metrics sink"""
+        snapshot = self.metrics()
+        if self.quality_controller is not None:
+            self.quality_controller(snapshot)
+        for sink in self.metrics_sinks:
+            try:
+                sink(snapshot)
+            except Exception as e:
+                print(f"Metrics export error: {e}")
+    
+    def _metrics_loop(self):
+        """Export metrics at a fixed interval until the recording stops"""
+        while not self._metrics_stop.wait(self.config.metrics_interval):
+            self.emit_metrics()
+    
+    def latency_stats(self):
+        """Capture, convert, resize and encode latency percentiles for the current recording"""
+        if self.frame_pipeline is None:
+            return {}
+        stats = self.frame_pipeline.latency_stats()
+        stats["resize"] = self.recording_session.resize_latency.snapshot()
+        return stats
+    
+    def get_screen_size(self):
+        """Get current screen size"""
+        if self.capture_backend is not None:
+            return self.capture_backend.size()
+        return load_pyautogui().size()
+    
+    def calculate_recording_resolution(self, target_resolution, source_size=None):
+        """Calculate actual recording resolution based on the captured area and target
+        
+        source_size is the size of the capture region; it defaults to the whole screen.
+        """
+        # Scale the captured area down to fit the preset, keeping its own aspect ratio so
+        # 4:3, 16:10 and odd-shaped regions are not stretched; an area that already fits
+        # is recorded as-is, with no resize
+        return fit_resolution(source_size or self.get_screen_size(), target_resolution)
+    
+    def setup_audio_recording(self):
+        """Setup audio recording based on the configured source"""
+        audio_option = self.config.audio_source
+        
+        if audio_option == "none":
+            return False
+        
+        try:
+            # Initialize PyAudio; it is only imported once an audio input is selected
+            self.audio_format = pyaudio.paInt16
+            self.audio = pyaudio.PyAudio()
+            
+            # Find appropriate audio device
+            device_index = None
+            if audio_option == "system_mic":
+                # Use default input device
+                device_index = None
+            elif audio_option == "external_mic":
+                # Try to find external microphone (this is a simplified approach)
+                for i in range(self.audio.get_device_count()):
+                    device_info = self.audio.get_device_info_by_index(i)
+                    device_name = str(device_info.get('name', ''))
+                    max_input_channels = device_info.get('maxInputChannels', 0)
+                    if isinstance(max_input_channels, (int, float)) and max_input_channels > 0 and 'headset' in device_name.lower():
+                        device_index = i
+                        break
+                # If no specific external mic found, use default
+                if device_index is None:
+                    device_index = None
+            
+            # Stream audio to disk through a bounded ring instead of holding it in memory
+            sample_width = self.audio.get_sample_size(self.audio_format)
+            self.audio_frame_size = sample_width * self.audio_channels
+            self.audio_ring = AudioRingBuffer(
+                int(self.audio_rate * self.config.audio_buffer_seconds) * self.audio_frame_size,
+                self.audio_frame_size)
+            self.audio_stats = AudioCaptureStats()
+            self.audio_start_time = None
+            
+            # Create a callback-driven audio stream; it is started with the recording threads
+            self.audio_stream = self.audio.open(
+                format=self.audio_format,
+                channels=self.audio_channels,
+                rate=self.audio_rate,
+                input=True,
+                input_device_index=device_index,
+                frames_per_buffer=self.audio_chunk,
+                stream_callback=self.audio_callback,
+                start=False
+            )
+            
+            if self.config.replay_seconds:
+                # Hold a little more audio than video so a replay never starts silent
+                self.audio_writer = ReplayAudioBuffer(self.config.replay_seconds + 5,
+                                                      self.audio_channels, sample_width, self.audio_rate)
+                return True
+            
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            audio_file_format = self.config.audio_file_format
+            if self.config.segmented and get_ffmpeg_exe():
+                # Segments are muxed while the track is still being written
+                audio_file_format = "pcm"
+            self.audio_writer = AudioFileWriter(
+                unique_path(f"temp_audio_{timestamp}.{audio_file_format}"),
+                self.audio_channels, sample_width, self.audio_rate, audio_file_format)
+            if self.journal is not None:
+                # After a crash the track is recovered into the video, not deleted; a
+                # segmented or per-monitor recording has no single file to attach it to
+                video = self.output_filename \
+                    if not self.config.segmented and len(self.output_files) == 1 else None
+                writer = self.audio_writer
+                self.journal.add_track(writer.path, video, writer.file_format, writer.channels,
+                                       writer.sample_width, writer.rate)
+            
+            return True
+        
+        except Exception as e:
+            print(f"Audio setup error: {e}")
+            return False
+    
+    def audio_callback(self, in_data, frame_count, time_info, status_flags):
+        """PyAudio callback: timestamp each buffer and hand it to the writer thread"""
+        now = time.monotonic()
+        stats = self.audio_stats
+        stats.buffers += 1
+        
+        if status_flags & pyaudio.paInputOverflow:
+            stats.overflows += 1
+        if status_flags & pyaudio.paInputUnderflow:
+            stats.underflows += 1
+        
+        # PortAudio times are on the stream clock; the gap since the ADC captured the
+        # buffer maps it onto time.monotonic for A/V alignment
+        adc_time = time_info.get('input_buffer_adc_time', 0) if time_info else 0
+        current_time = time_info.get('current_time', 0) if time_info else 0
+        if adc_time and current_time and current_time >= adc_time:
+            latency = current_time - adc_time
+        else:
+            latency = frame_count / self.audio_rate
+        stats.record_latency(latency)
+        
+        # Keep the stream running while paused so the device buffer never overruns
+        if self.is_recording and not self.is_paused and in_data:
+            if self.audio_start_time is None:
+                self.audio_start_time = now - latency
+            dropped = self.audio_ring.write(in_data)
+            stats.dropped_samples += dropped // self.audio_frame_size
+        
+        return (None, pyaudio.paContinue)
+    
+    def record_audio(self):
+        """Drain captured audio to disk in a separate thread"""
+        block_size = self.audio_ring.capacity // 4
+        
+        try:
+            while self.is_recording or len(self.audio_ring):
+                data = self.audio_ring.read(block_size, timeout=0.1)
+                if data:
+                    self.audio_writer.write(data)
+        except Exception as e:
+            print(f"Audio recording error: {e}")
+    
+    def get_audio_stats(self):
+        """Audio stream health counters plus how full the ring buffer is"""
+        stats = self.audio_stats.snapshot()
+        if self.audio_ring:
+            stats["buffer_fill"] = len(self.audio_ring) / self.audio_ring.capacity
+        stats["sample_rate"] = self.audio_rate
+        stats["chunk_size"] = self.audio_chunk
+        return stats
+    
+    def save_audio(self):
+        """Finish the streamed audio file and return its path, or None if nothing was recorded"""
+        if not self.audio_writer:
+            return None
+        
+        writer, self.audio_writer = self.audio_writer, None
+        try:
+            writer.close()
+        except Exception as e:
+            print(f"Audio save error: {e}")
+            return None
+        
+        stats = self.audio_stats
+        if stats.overflows or stats.underflows or stats.dropped_samples:
+            print(f"Audio: {stats.overflows} overflows, {stats.underflows} underflows, "
+                  f"{stats.dropped_samples} samples dropped")
+        
+        if not writer.frames_written:
+            self._discard_temp_file(writer.path)
+            return None
+        return writer.path
+    
+    def can_merge_audio(self):
+        """Whether an audio track can be attached to the recording automatically"""
+        return moviepy_available() or bool(self.config.merge_mode == "remux" and get_ffmpeg_exe())
+    
+    def mux_audio_video(self, video_file, audio_file, audio_offset=0.0):
+        """Attach audio to the recording with ffmpeg, copying the already encoded video"""
+        base_name = os.path.splitext(video_file)[0]
+        final_output = f"{base_name}_with_audio.mp4"
+        self._track_temp_file(final_output)
+        
+        try:
+            # Trim to the shorter stream by timestamp, as the MoviePy path does by decoding
+            video_duration = probe_duration(video_file)
+            audio_duration = probe_duration(audio_file)
+            duration = None
+            if video_duration and audio_duration:
+                duration = min(video_duration, audio_duration + audio_offset)
+            
+            remux_audio_video(video_file, audio_file, final_output, audio_offset, duration,
+                              cancel=self._finalize_cancel)
+        except FinalizeCancelled:
+            print("Audio merge cancelled; the audio is kept in a separate file")
+            self._discard_temp_file(final_output)
+            return False
+        except Exception as e:
+            print(f"Audio-video mux error: {e}")
+            self._discard_temp_file(final_output)
+            return False
+        
+        # Replace original video file with merged version
+        try:
+            os.replace(final_output, video_file)
+        except OSError:
+            # If renaming fails, keep both files
+            self.output_filename = final_output
+        self._keep_temp_file(final_output)
+        return True
+    
+    def merge_audio_video(self, video_file, audio_file, audio_offset=0.0):
+        """Merge audio and video files, remuxing with ffmpeg when possible
+        
+        audio_offset is how many seconds after the first video frame the audio started.
+        """
+        if self.config.merge_mode == "remux" and get_ffmpeg_exe():
+            started = time.monotonic()
+            if self.mux_audio_video(video_file, audio_file, audio_offset):
+                self.report_merge("remux", time.monotonic() - started, self.output_filename)
+                return True
+            if self.finalize_cancelled:
+                return False
+            print("Stream-copy remux failed, re-encoding with moviepy instead")
+        
+        # A MoviePy re-encode cannot be interrupted, so it is not started once cancelled
+        if self.finalize_cancelled or not moviepy_available():
+            return False
+        
+        started = time.monotonic()
+        success = self.reencode_audio_video(video_file, audio_file, audio_offset)
+        if success:
+            self.report_merge("reencode", time.monotonic() - started, self.output_filename)
+        return success
+    
+    def report_merge(self, mode, elapsed, output_file):
+        """Record how long post-processing took and estimate the time saved over a re-encode"""
+        duration = probe_duration(output_file) if mode == "remux" else None
+        report = {"mode": mode, "elapsed": elapsed, "media_duration": duration}
+        
+        if duration:
+            estimated_reencode = duration / MOVIEPY_REENCODE_SPEED
+            report["estimated_time_saved"] = max(0.0, estimated_reencode - elapsed)
+            print(f"Remuxed {duration:.1f}s of video in {elapsed:.2f}s "
+                  f"(~{report['estimated_time_saved']:.1f}s faster than re-encoding)")
+        else:
+            print(f"Audio merge ({mode}) took {elapsed:.2f}s")
+        
+        self.last_merge_report = report
+    
+    def reencode_audio_video(self, video_file, audio_file, audio_offset=0.0):
+        """Merge audio and video files using moviepy, re-encoding both streams"""
+        final_output = None
+        try:
+            # MoviePy is imported here, the only place it is used
+            moviepy = load_moviepy()
+            if moviepy is None:
+                print("MoviePy could not be loaded")
+                return False
+            
+            # Load video and audio clips
+            video_clip = moviepy.VideoFileClip(video_file)
+            audio_clip = moviepy.AudioFileClip(audio_file)
+            
+            # MoviePy 2 renamed subclip to subclipped and the set_* methods to with_*
+            legacy = hasattr(video_clip, "subclip")
+            
+            def subclip(clip, start, end=None):
+                return clip.subclip(start, end) if legacy else clip.subclipped(start, end)
+            
+            # Line the audio up with the first captured frame
+            if audio_offset < 0:
+                audio_clip = subclip(audio_clip, -audio_offset)
+            elif audio_offset > 0:
+                shifted = audio_clip.set_start(audio_offset) if legacy else audio_clip.with_start(audio_offset)
+                audio_clip = moviepy.CompositeAudioClip([shifted])
+            
+            # Get minimum duration to avoid sync issues
+            min_duration = min(video_clip.duration, audio_clip.duration)
+            
+            # Trim clips to same duration
+            video_clip = subclip(video_clip, 0, min_duration)
+            audio_clip = subclip(audio_clip, 0, min_duration)
+            
+            # Set audio to video
+            final_clip = video_clip.set_audio(audio_clip) if legacy else video_clip.with_audio(audio_clip)
+            
+            # Create output filename for final video
+            base_name = os.path.splitext(video_file)[0]
+            final_output = f"{base_name}_with_audio.mp4"
+            self._track_temp_file(final_output)
+            
+            # Write final video with audio; MoviePy 2 dropped the verbose flag
+            options = {"verbose": False} if legacy else {}
+            final_clip.write_videofile(final_output, codec='libx264', audio_codec='aac', logger=None,
+                                       **options)
+            
+            # Close clips to free memory
+            video_clip.close()
+            audio_clip.close()
+            final_clip.close()
+            
+            # Replace original video file with merged version
+            try:
+                os.remove(video_file)
+                os.rename(final_output, video_file)
+            except:
+                # If renaming fails, keep both files
+                self.output_filename = final_output
+            self._keep_temp_file(final_output)
+            
+            return True
+        
+        except Exception as e:
+            print(f"Audio-video merge error: {e}")
+            if final_output:
+                self._discard_temp_file(final_output)
+            return False
+    
+    def finalize_segment(self, segment):
+        """Mux the matching slice of the audio track into a closed segment
+        
+        Runs on the segment writer's background thread while recording continues.
+        """
+        writer = self.audio_writer
+        if writer is None or writer.file_format != "pcm":
+            return
+        
+        # Give the audio writer a moment to catch up with the end of the segment
+        audio_offset = self.get_audio_offset()
+        needed = (segment.start_time + segment.duration - audio_offset) * self.audio_rate
+        deadline = time.monotonic() + 5
+        while self.is_recording and writer.frames_written < needed and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if not writer.frames_written:
+            return
+        
+        muxed_file = os.path.splitext(segment.path)[0] + "_with_audio.mp4"
+        self._track_temp_file(muxed_file)
+        try:
+            remux_audio_video(segment.path, writer.path, muxed_file,
+                              audio_offset - segment.start_time, segment.duration,
+                              audio_input_options=writer.input_options(),
+                              cancel=self._finalize_cancel)
+            os.replace(muxed_file, segment.path)
+        except FinalizeCancelled:
+            print(f"Segment {segment.index} audio mux cancelled")
+        except Exception as e:
+            print(f"Segment {segment.index} audio mux error: {e}")
+        self._discard_temp_file(muxed_file)
+    
+    def finish_segments(self, writer, temp_audio_file):
+        """Remove the shared audio track and stitch the segments together if requested"""
+        segments = [segment.path for segment in writer.segments]
+        result = {"audio_file": None, "audio_merge_failed": False, "segments": segments,
+                  "manifest": writer.manifest_path}
+        
+        if temp_audio_file and temp_audio_file.endswith(".pcm") and not self.finalize_cancelled:
+            # Every segment already carries its slice of the audio
+            self._discard_temp_file(temp_audio_file)
+        elif temp_audio_file:
+            result["audio_file"] = temp_audio_file
+            self._keep_temp_file(temp_audio_file)
+        
+        result["output_filename"] = writer.manifest_path
+        if len({segment.size for segment in writer.segments}) > 1:
+            # Stream copy cannot join segments recorded at different resolutions
+            print("Segments differ in resolution after quality changes; leaving them separate")
+        elif self.config.stitch_segments and segments and not self.finalize_cancelled:
+            self._status("Joining segments...")
+            self._track_temp_file(self.output_filename)
+            try:
+                concat_segments(writer.manifest_path, self.output_filename, self._finalize_cancel)
+            except FinalizeCancelled:
+                print("Segment stitching cancelled; the segments are kept")
+                self._discard_temp_file(self.output_filename)
+                return result
+            except Exception as e:
+                print(f"Segment stitch error: {e}")
+                self._discard_temp_file(self.output_filename)
+                return result
+            self._keep_temp_file(self.output_filename)
+            
+            for path in segments + [writer.manifest_path]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            result["output_filename"] = self.output_filename
+            result["segments"] = []
+            result["manifest"] = None
+        return result
+    
+    def save_replay(self, path=None, on_saved=None):
+        """Write the replay buffer to an MP4 in the background while recording continues
+        
+        Returns the path being written. on_saved, if given, is called from the saving
+        thread with the path, or None if the save failed.
+        """
+        if not self.is_recording or not isinstance(self.video_writer, ReplayBufferWriter):
+            raise RuntimeError("The replay buffer is not recording")
+        
+        video, video_start = self.video_writer.snapshot()
+        if video is None:
+            raise RuntimeError("The replay buffer is still empty")
+        
+        # Take the audio from the same point in the recording as the first keyframe
+        audio = None
+        audio_writer = self.audio_writer
+        if isinstance(audio_writer, ReplayAudioBuffer) and self.audio_start_time is not None:
+            audio_offset = self.get_audio_offset()
+            first_frame, pcm = audio_writer.snapshot(max(0, int((video_start - audio_offset) * self.audio_rate)))
+            if pcm:
+                audio = (pcm, audio_offset + first_frame / self.audio_rate - video_start,
+                         audio_writer.input_options())
+        
+        # Saves in the same second must not share the output or the temporary files,
+        # which only exist once the saving thread has started writing them
+        with self._replay_lock:
+            path = unique_path(path or datetime.now().strftime("replay_%Y%m%d_%H%M%S.mp4"),
+                               self._replay_files)
+            base_name = os.path.splitext(path)[0]
+            video_file = unique_path(f"{base_name}_video.flv", self._replay_files)
+            audio_file = unique_path(f"{base_name}_audio.pcm", self._replay_files)
+            files = (path, video_file, audio_file)
+            self._replay_files.update(files)
+        
+        thread = threading.Thread(target=self._write_replay,
+                                  args=(files, video, audio, on_saved), daemon=True)
+        self._replay_threads = [t for t in self._replay_threads if t.is_alive()] + [thread]
+        thread.start()
+        return path
+    
+    def _write_replay(self, files, video, audio, on_saved):
+        """Remux a replay snapshot into an MP4; runs on its own thread
+        
+        files is the output path and the two temporary paths reserved by save_replay.
+        """
+        path, video_file, audio_file = files
+        self._track_temp_file(video_file)
+        self._track_temp_file(audio_file)
+        
+        try:
+            with open(video_file, "wb") as f:
+                f.write(video)
+            
+            if audio is None:
+                run_ffmpeg(["-i", video_file, "-c", "copy", "-movflags", "+faststart", path])
+            else:
+                pcm, audio_offset, input_options = audio
+                with open(audio_file, "wb") as f:
+                    f.write(pcm)
+                remux_audio_video(video_file, audio_file, path, audio_offset,
+                                  probe_duration(video_file), audio_input_options=input_options)
+            
+            self.saved_replays.append(path)
+            print(f"Replay saved to: {os.path.abspath(path)}")
+        except Exception as e:
+            print(f"Replay save error: {e}")
+            path = None
+        finally:
+            for temp_file in (video_file, audio_file):
+                self._discard_temp_file(temp_file)
+            with self._replay_lock:
+                self._replay_files.difference_update(files)
+        
+        if on_saved:
+            on_saved(path)
+    
+    def finish_replay(self):
+        """Release the replay buffer after waiting for any saves still in progress"""
+        self.release_resources()
+        
+        for thread in self._replay_threads:
+            thread.join()
+        self._replay_threads = []
+        
+        if self.audio_writer:
+            self.audio_writer.close()
+            self.audio_writer = None
+        
+        return {
+            "output_filename": self.saved_replays[-1] if self.saved_replays else None,
+            "audio_file": None,
+            "audio_merge_failed": False,
+            "replays": list(self.saved_replays),
+        }
+    
+    def get_audio_offset(self):
+        """Seconds between the first captured video frame and the first audio chunk"""
+        if self.audio_start_time is None or self.frame_pipeline is None:
+            return 0.0
+        if self.frame_pipeline.video_start_time is None:
+            return 0.0
+        return self.audio_start_time - self.frame_pipeline.video_start_time
+    
+    def start(self):
+        """Open the capture source, video writer and audio stream and start recording
+        
+        Returns True if audio is being recorded. Raises if recording could not start.
+        """
+        if self.is_recording:
+            raise RuntimeError("Recording is already in progress")
+        
+        config = self.config
+        
+        try:
+            # Generate output filename
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.output_filename = config.output_filename or \
+                unique_path(f"screen_recording_{timestamp}.mp4")
+            self._finalize_cancel.clear()
+            self.journal = TempFileJournal(os.path.splitext(self.output_filename)[0] +
+                                           TempFileJournal.SUFFIX)
+            
+            # Select the capture backend and region before querying the capture size
+            self.capture_backend = create_capture_backend(config.capture_backend,
+                                                          **config.capture_options)
+            if config.multi_monitor:
+                self.monitor_capture = MultiMonitorCapture(self.capture_backend, config.fps)
+                source_size = self.monitor_capture.size()
+                # Keep the composite's aspect ratio rather than stretching it to 16:9; with
+                # separate files it is each monitor, not the whole canvas, that has to fit
+                fit_size = source_size
+                if config.multi_monitor == "separate":
+                    fit_size = max((tile[2:] for tile in self.monitor_capture.tiles),
+                                   key=lambda size: max(size[0] / config.resolution[0],
+                                                        size[1] / config.resolution[1]))
+                scale = fit_resolution(fit_size, config.resolution)[0] / fit_size[0]
+                actual_resolution = (int(source_size[0] * scale) // 2 * 2,
+                                     int(source_size[1] * scale) // 2 * 2)
+            else:
+                self.region_capture = RegionCapture(self.capture_backend, config.region)
+                source_size = self.region_capture.size()
+                
+                # Get recording resolution
+                actual_resolution = self.calculate_recording_resolution(config.resolution, source_size)
+            
+            # Lock in the session settings for the recording threads
+            self.recording_session = RecordingSession(
+                source_size,
+                actual_resolution,
+                self.capture_backend.pixel_format,
+                config.fps,
+                buffer_count=config.pipeline_queue_size + 2 * config.pipeline_workers + 2
+            )
+            
+            # Setup video writer
+            self.output_files = [self.output_filename]
+            if config.multi_monitor == "separate":
+                self.video_writer = self.open_monitor_writers(source_size, actual_resolution)
+            elif config.replay_seconds:
+                self.video_writer = ReplayBufferWriter(
+                    config.fps, actual_resolution, config.replay_seconds,
+                    config.replay_max_megabytes, **config.encoder_options)
+            elif config.segmented:
+                self.video_writer = SegmentedVideoWriter(
+                    self.output_filename, config.fps,
+                    # Adaptive quality may change the size and preset between segments
+                    lambda path: create_video_writer(path, config.fps,
+                                                     self.recording_session.output_size,
+                                                     config.video_encoder, **self.encoder_options),
+                    segment_seconds=config.segment_seconds,
+                    segment_megabytes=config.segment_megabytes,
+                    finalize_segment=self.finalize_segment,
+                    frame_size=actual_resolution
+                )
+            else:
+                self.video_writer = create_video_writer(self.output_filename, config.fps,
+                                                        actual_resolution, config.video_encoder,
+                                                        **config.encoder_options)
+            
+            if not self.video_writer.isOpened():
+                raise Exception("Failed to initialize video writer")
+            
+            if config.stream_port is not None:
+                self.stream_server = MJPEGStreamServer(config.stream_host, config.stream_port,
+                                                       config.stream_fps)
+                self.stream_server.start()
+            
+            # Setup audio recording if selected
+            self.audio_enabled = self.setup_audio_recording()
+        except Exception:
+            self.release_resources()
+            if self.journal is not None:
+                self.journal.close()
+            raise
+        
+        self.is_recording = True
+        self.is_paused = False
+        
+        # Start the video pipeline
+        session = self.recording_session
+        self.change_detector = FrameChangeDetector(max_repeats=int(session.fps)) \
+            if config.skip_unchanged_frames else None
+        capture = self.monitor_capture or self.region_capture
+        if self.monitor_capture:
+            self.monitor_capture.start()
+        self.frame_pipeline = FramePipeline(
+            capture.grab,
+            session.convert,
+            self.write_and_stream if self.stream_server else self.video_writer.write,
+            workers=config.pipeline_workers,
+            queue_size=config.pipeline_queue_size,
+            drop_policy=config.frame_drop_policy,
+            fps=session.fps,
+            release_frame=session.release,
+            change_detector=self.change_detector,
+            release_capture=self.monitor_capture.release if self.monitor_capture else None
+        )
+        self.frame_pipeline.start()
+        
+        if config.adaptive_quality:
+            # Only a segmented writer can reopen its encoder with a new size or preset
+            resizable = isinstance(self.video_writer, SegmentedVideoWriter)
+            uses_ffmpeg = config.video_encoder == "ffmpeg" or \
+                (config.video_encoder == "auto" and get_ffmpeg_exe() is not None)
+            levels = quality_levels(session.output_size, session.fps,
+                                    self.encoder_options["preset"] if uses_ffmpeg else None,
+                                    resizable=resizable)
+            self.quality_controller = AdaptiveQualityController(levels, self.apply_quality_level)
+        
+        if self.metrics_sinks or self.quality_controller:
+            self._metrics_stop.clear()
+            self._metrics_thread = threading.Thread(target=self._metrics_loop, daemon=True)
+            self._metrics_thread.start()
+        
+        if self.audio_enabled:
+            self.audio_thread = threading.Thread(target=self.record_audio, daemon=True)
+            self.audio_thread.start()
+            self.audio_stream.start_stream()
+        
+        return self.audio_enabled
+    
+    def pause(self):
+        """Pause the recording"""
+        # Audio is gated by is_paused from this moment, so video pauses at the same time
+        now = time.monotonic()
+        self.is_paused = True
+        if self.frame_pipeline:
+            self.frame_pipeline.pause(now)
+        if self.monitor_capture:
+            self.monitor_capture.pause(now)
+    
+    def resume(self):
+        """Resume the recording"""
+        now = time.monotonic()
+        self.is_paused = False
+        if self.frame_pipeline:
+            self.frame_pipeline.resume(now)
+        if self.monitor_capture:
+            self.monitor_capture.resume(now)
+    
+    def apply_quality_level(self, level):
+        """Switch the running recording to another adaptive quality level"""
+        self.frame_pipeline.scheduler.stride = level.capture_stride
+        if level.output_size != self.recording_session.output_size:
+            self.recording_session.set_output_size(level.output_size)
+            self.video_writer.frame_size = level.output_size
+        if level.preset and level.preset != self.encoder_options["preset"]:
+            self.encoder_options["preset"] = level.preset
+            self.video_writer.reopen()
+    
+    def write_and_stream(self, frame):
+        """Write a frame to the output file and offer it to the live stream"""
+        self.video_writer.write(frame)
+        self.stream_server.offer(frame)
+    
+    def open_monitor_writers(self, canvas_size, output_size):
+        """Open one video writer per monitor, cutting each out of the scaled composite"""
+        config = self.config
+        scale_x = output_size[0] / canvas_size[0]
+        scale_y = output_size[1] / canvas_size[1]
+        base_name = os.path.splitext(self.output_filename)[0]
+        
+        writers = []
+        tiles = []
+        self.output_files = []
+        try:
+            for index, (x, y, width, height) in enumerate(self.monitor_capture.tiles, start=1):
+                tile = (int(x * scale_x) // 2 * 2, int(y * scale_y) // 2 * 2,
+                        int(width * scale_x) // 2 * 2, int(height * scale_y) // 2 * 2)
+                path = f"{base_name}_monitor{index}.mp4"
+                writers.append(create_video_writer(path, config.fps, tile[2:], config.video_encoder,
+                                                   **config.encoder_options))
+                tiles.append(tile)
+                self.output_files.append(path)
+        except Exception:
+            for writer in writers:
+                writer.release()
+            raise
+        
+        self.output_filename = self.output_files[0]
+        return SplitVideoWriter(writers, tiles)
+    
+    def release_resources(self):
+        """Close the writer, live stream, audio stream and capture backend"""
+        self.release_capture()
+        
+        # Release video writer
+        if self.video_writer:
+            self.video_writer.release()
+            self.video_writer = None
+    
+    def release_capture(self):
+        """Close the live stream, audio stream and capture backend, keeping the writer open"""
+        if self.stream_server:
+            self.stream_server.stop()
+            self.stream_server = None
+        
+        # Clean up audio
+        if self.audio_stream:
+            self.audio_stream.stop_stream()
+            self.audio_stream.close()
+            self.audio_stream = None
+        
+        if self.audio:
+            self.audio.terminate()
+            self.audio = None
+        
+        if self.monitor_capture:
+            self.monitor_capture.stop()
+        
+        if self.capture_backend:
+            self.capture_backend.close()
+            self.capture_backend = None
+            self.region_capture = None
+    
+    def stop(self):
+        """Stop recording, finish the output file and attach the audio
+        
+        Returns a dict with the final output_filename, audio_file (set when the audio
+        had to be left in a separate file) and audio_merge_failed. Segmented recordings
+        also list their segments and manifest; output_filename is then the manifest
+        unless the segments were stitched together.
+        """
+        self.stop_capture()
+        return self.finalize()
+    
+    def stop_capture(self):
+        """Stop capturing screen and audio, leaving the files to finalize()
+        
+        Only waits for frames already in flight, so a front end can hand finalize() to
+        a FinalizeQueue and start the next recording straight away.
+        """
+        # Stop recording
+        self.is_recording = False
+        self.is_paused = False
+        
+        # Drain frames still in flight before the writer is released
+        if self.frame_pipeline:
+            self.frame_pipeline.stop()
+        
+        metrics_running = self._metrics_thread is not None
+        if metrics_running:
+            self._metrics_stop.set()
+            self._metrics_thread.join()
+            self._metrics_thread = None
+        
+        if self.audio_thread and self.audio_thread.is_alive():
+            self.audio_thread.join(timeout=5)
+        
+        # Reporting goes through print and the metrics sinks, which may fail (a closed
+        # stdout, say); the devices are released regardless
+        try:
+            if self.frame_pipeline:
+                stats = self.recording_session.stats()
+                print(f"Video: {self.frame_pipeline.frames_written} frames written, "
+                      f"{stats['conversion_fps']:.1f} conversions/s, "
+                      f"{stats['buffer_allocations']} frame buffers allocated, "
+                      f"{self.frame_pipeline.skipped_frames} unchanged frames skipped")
+            
+            # Export a final snapshot covering the whole recording
+            if metrics_running:
+                self.emit_metrics()
+        finally:
+            self.release_capture()
+    
+    def cancel_finalize(self):
+        """Cut finalize() short: a running ffmpeg merge is killed and the audio is kept
+        in its own file. The video itself is always finished."""
+        self._finalize_cancel.set()
+    
+    @property
+    def finalize_cancelled(self):
+        return self._finalize_cancel.is_set()
+    
+    def finalize(self):
+        """Finish the output files and attach the audio once capture has stopped
+        
+        Returns the dict described in stop(), with cancelled set if cancel_finalize()
+        was called. finalize_progress goes from 0 to 1 as the steps complete.
+        """
+        self.finalize_progress = 0.0
+        try:
+            if self.config.replay_seconds:
+                result = self.finish_replay()
+            else:
+                result = self.finish_outputs()
+        finally:
+            # If a step or a status callback failed, still close the video and the audio
+            # so both files are complete; the audio is then left beside the video
+            self.release_resources()
+            if self.audio_writer:
+                self.audio_writer.close()
+                self.audio_writer = None
+            if self.journal is not None:
+                self.journal.close()
+        
+        result["cancelled"] = self.finalize_cancelled
+        self.finalize_progress = 1.0
+        return result
+    
+    def finish_outputs(self):
+        """Release the writer, save the audio and merge it into every output file"""
+        self._status("Finishing video...")
+        # Releasing a segmented writer waits for the last segment to be finalized
+        segment_writer = self.video_writer if self.config.segmented else None
+        self.release_resources()
+        
+        # Finish the streamed audio file
+        temp_audio_file = self.save_audio()
+        self.finalize_progress = 0.3
+        if segment_writer is not None:
+            return self.finish_segments(segment_writer, temp_audio_file)
+        
+        result = {"audio_file": None, "audio_merge_failed": False}
+        
+        # Merge audio if recorded
+        if temp_audio_file and self.can_merge_audio() and not self.finalize_cancelled:
+            self._status("Processing audio...")
+            
+            self.temp_audio_file = temp_audio_file
+            success = True
+            # Every per-monitor file gets its own copy of the audio track
+            for index, video_file in enumerate(self.output_files):
+                if self.finalize_cancelled:
+                    success = False
+                    break
+                self.output_filename = video_file
+                success = self.merge_audio_video(video_file, temp_audio_file,
+                                                 self.get_audio_offset()) and success
+                self.output_files[index] = self.output_filename
+                self.finalize_progress = 0.3 + 0.7 * (index + 1) / len(self.output_files)
+            self.output_filename = self.output_files[0]
+            if not success:
+                result["audio_file"] = temp_audio_file
+                result["audio_merge_failed"] = not self.finalize_cancelled
+                self._keep_temp_file(temp_audio_file)
+            else:
+                # Clean up temporary audio file
+                self._discard_temp_file(temp_audio_file)
+        elif temp_audio_file:
+            # Leave the audio separate if neither ffmpeg nor moviepy is available
+            result["audio_file"] = temp_audio_file
+            self._keep_temp_file(temp_audio_file)
+        
+        result["output_filename"] = self.output_filename
+        if len(self.output_files) > 1:
+            result["outputs"] = list(self.output_files)
+        return result
+    
+    def _track_temp_file(self, path):
+        if self.journal is not None:
+            self.journal.add(path)
+    
+    def _discard_temp_file(self, path):
+        if self.journal is not None:
+            self.journal.discard(path)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def _keep_temp_file(self, path):
+        if self.journal is not None:
+            self.journal.keep(path)
 
-# Handle display-related imports for headless environments
-try:
-    import pyautogui
-    # Disable failsafe for automated environments
-    pyautogui.FAILSAFE = False
-    PYAUTOGUI_AVAILABLE = True
-except ImportError:
-    pyautogui = None
-    PYAUTOGUI_AVAILABLE = False
-except Exception:
-    # Handle X11 display issues in headless environments
-    pyautogui = None
-    PYAUTOGUI_AVAILABLE = False
 
-# Mock pyautogui functions for headless environments
-class MockPyAutoGUI:
-    @staticmethod
-    def size():
-        return (1920, 1080)  # Default screen size
-    
-    @staticmethod
-    def screenshot():
-        # Create a mock screenshot (black image)
-        import numpy as np
-        from PIL import Image
-        return Image.fromarray(np.zeros((1080, 1920, 3), dtype=np.uint8))
+class FinalizeJob:
+    """Post-processing of one stopped recording, run by a FinalizeQueue
+    
+    state goes from "queued" to "running" and then "done", "cancelled" or "failed".
+    message is the latest status from the engine and result is what finalize()
+    returned. Cancelling keeps the finished video and leaves the audio separate.
+    """
+    
+    def __init__(self, engine):
+        self.engine = engine
+        self.state = "queued"
+        self.message = "Waiting..."
+        self.result = None
+        self.error = None
+        self._on_status = None
+        self._done = threading.Event()
+    
+    @property
+    def progress(self):
+        """Fraction of the post-processing steps completed, from 0 to 1"""
+        return self.engine.finalize_progress if self.state != "queued" else 0.0
+    
+    @property
+    def finished(self):
+        return self._done.is_set()
+    
+    def cancel(self):
+        """Stop at the next step; a running ffmpeg merge is killed"""
+        if not self.finished:
+            self.engine.cancel_finalize()
+    
+    def wait(self, timeout=None):
+        """Block until the job has finished; returns False on timeout"""
+        return self._done.wait(timeout)
+    
+    def _set_message(self, message):
+        self.message = message
+        if self._on_status:
+            self._on_status(message)
+    
+    def run(self):
+        self.state = "running"
+        # Status messages still reach the engine's own on_status, if it has one
+        self._on_status = self.engine.on_status
+        self.engine.on_status = self._set_message
+        try:
+            self.result = self.engine.finalize()
+            self.state = "cancelled" if self.result.get("cancelled") else "done"
+        except Exception as e:
+            self.error = e
+            self.state = "failed"
+            print(f"Finalize error: {e}")
+        finally:
+            # Waiters must be released even if reporting the error fails
+            self._done.set()
 
-if not PYAUTOGUI_AVAILABLE:
-    pyautogui = MockPyAutoGUI()
+
+class FinalizeQueue:
+    """Finish stopped recordings one at a time on a background thread
+    
+    submit() stops capture and returns at once, so the next recording can start while
+    earlier ones are still being muxed. Jobs run in the order they were submitted.
+    """
+    
+    def __init__(self):
+        self.jobs = []
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+    
+    def submit(self, engine):
+        """Stop the engine's capture if it is still running and queue its finalize()
+        
+        If stopping raises, the job is queued anyway, since its writer still has to be
+        closed, and the error is passed on.
+        """
+        job = FinalizeJob(engine)
+        try:
+            if engine.is_recording:
+                engine.stop_capture()
+        finally:
+            with self._lock:
+                self.jobs.append(job)
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, daemon=True)
+                    self._worker.start()
+            self._pending.put(job)
+        return job
+    
+    def _run(self):
+        while True:
+            # A job cancelled while queued still closes its video and keeps the audio
+            job = self._pending.get()
+            try:
+                job.run()
+            except Exception:
+                pass  # Already recorded on the job; carry on with the next one
+    
+    def active(self):
+        """Jobs that are queued or running, oldest first"""
+        with self._lock:
+            return [job for job in self.jobs if not job.finished]
+    
+    def pop_finished(self):
+        """Remove and return the jobs that have finished since the last call"""
+        with self._lock:
+            finished = [job for job in self.jobs if job.finished]
+            self.jobs = [job for job in self.jobs if not job.finished]
+        return finished
+    
+    def cancel_all(self):
+        for job in self.active():
+            job.cancel()
+    
+    def wait(self, timeout=None):
+        """Block until every submitted job has finished; returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job in self.active():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not job.wait(remaining):
+                return False
+        return True
 
 
 class ScreenRecorder:
-    def __init__(self, root):
+    def __init__(self, root, audio_rate=44100, audio_chunk=1024, replay_seconds=30):
         self.root = root
         self.root.title("Windows 10 Screen Recorder")
-        self.root.geometry("500x400")
+        self.root.geometry("500x600")
         self.root.resizable(False, False)
         
-        # Recording state variables
-        self.is_recording = False
-        self.is_paused = False
-        self.video_writer = None
-        self.audio_thread = None
-        self.video_thread = None
-        self.output_filename = None
-        self.temp_audio_file = None
+        # Recording engine; a new one is created for each recording
+        self.engine = None
+        self.audio_rate = audio_rate
+        self.audio_chunk = audio_chunk
+        self.replay_seconds = replay_seconds
+        self.error_reported = False
         
-        # Audio recording variables
-        self.audio_frames = []
-        self.audio_stream = None
-        self.audio_format = pyaudio.paInt16
-        self.audio_channels = 2
-        self.audio_rate = 44100
-        self.audio_chunk = 1024
+        # Stopped recordings are finished in the background while the next one records
+        self.finalizer = FinalizeQueue()
+        self.jobs_polling = False
+        self.closing = False
+        
+        # Clear up after a recorder that crashed; the user is told about any recovered audio
+        # once the window is up
+        self.recovery = TempFileJournal.clean_up_stale()
+        if self.recovery["removed"]:
+            print(f"Removed {len(self.recovery['removed'])} temporary files left by an earlier recording")
         
         # Resolution options
-        self.resolution_options = {
-            "HD (720p)": (1280, 720),
-            "Full HD (1080p)": (1920, 1080),
-            "4K (2160p)": (3840, 2160)
+        self.resolution_options = RESOLUTION_OPTIONS
+        
+        # Frame rate options
+        self.fps_options = {
+            "15 FPS": 15.0,
+            "24 FPS": 24.0,
+            "30 FPS": 30.0,
+            "60 FPS": 60.0
         }
         
+        # Capture area options; monitor entries are added once the monitors are known
+        self.capture_area_options = {"Full Screen": CaptureRegion("full")}
+        monitors = list_monitors()
+        for index, _ in enumerate(monitors, start=1):
+            self.capture_area_options[f"Monitor {index}"] = CaptureRegion("monitor", monitor=index)
+        if len(monitors) > 1:
+            # Multi-monitor modes are passed straight to RecordingConfig.multi_monitor
+            self.capture_area_options["All Monitors (side by side)"] = "composite"
+            self.capture_area_options["All Monitors (separate files)"] = "separate"
+        self.capture_area_options["Topmost Window"] = CaptureRegion(
+            "window", exclude_title=self.root.title())
+        
         # Audio input options
         self.audio_options = {
             "No Audio": "none",
@@ -87,10 +3983,18 @@ class ScreenRecorder:
         
         self.setup_ui()
         
-        # Check if we're in a supported environment
-        if not PYAUTOGUI_AVAILABLE:
+        # Screen capture is only simulated when neither mss nor pyautogui can grab the
+        # screen; pyautogui is not imported just for this check while mss is available
+        if not MSS_AVAILABLE and not pyautogui_available():
             self.show_environment_warning()
         
+        if self.recovery["recovered"]:
+            self.show_recovery()
+    
+    @property
+    def is_recording(self):
+        return self.engine is not None and self.engine.is_recording
+    
     def setup_ui(self):
         # Main frame
         main_frame = ttk.Frame(self.root, padding="20")
@@ -103,55 +4007,105 @@ class ScreenRecorder:
         # Resolution selection
         ttk.Label(main_frame, text="Recording Quality:").grid(row=1, column=0, sticky=tk.W, pady=(0, 5))
         self.resolution_var = tk.StringVar(value="Full HD (1080p)")
-        resolution_combo = ttk.Combobox(main_frame, textvariable=self.resolution_var, 
-                                      values=list(self.resolution_options.keys()), 
+        resolution_combo = ttk.Combobox(main_frame, textvariable=self.resolution_var,
+                                      values=list(self.resolution_options.keys()),
                                       state="readonly", width=25)
         resolution_combo.grid(row=1, column=1, sticky=tk.W, pady=(0, 5))
         
+        # Frame rate selection
+        ttk.Label(main_frame, text="Frame Rate:").grid(row=2, column=0, sticky=tk.W, pady=(0, 5))
+        self.fps_var = tk.StringVar(value="30 FPS")
+        fps_combo = ttk.Combobox(main_frame, textvariable=self.fps_var,
+                               values=list(self.fps_options.keys()),
+                               state="readonly", width=25)
+        fps_combo.grid(row=2, column=1, sticky=tk.W, pady=(0, 5))
+        
+        # Capture area selection
+        ttk.Label(main_frame, text="Capture Area:").grid(row=3, column=0, sticky=tk.W, pady=(0, 5))
+        self.capture_area_var = tk.StringVar(value="Full Screen")
+        capture_area_combo = ttk.Combobox(main_frame, textvariable=self.capture_area_var,
+                                        values=list(self.capture_area_options.keys()),
+                                        state="readonly", width=25)
+        capture_area_combo.grid(row=3, column=1, sticky=tk.W, pady=(0, 5))
+        
         # Audio selection
-        ttk.Label(main_frame, text="Audio Input:").grid(row=2, column=0, sticky=tk.W, pady=(0, 20))
+        ttk.Label(main_frame, text="Audio Input:").grid(row=4, column=0, sticky=tk.W, pady=(0, 20))
         self.audio_var = tk.StringVar(value="System Microphone")
         audio_combo = ttk.Combobox(main_frame, textvariable=self.audio_var,
                                  values=list(self.audio_options.keys()),
                                  state="readonly", width=25)
-        audio_combo.grid(row=2, column=1, sticky=tk.W, pady=(0, 20))
+        audio_combo.grid(row=4, column=1, sticky=tk.W, pady=(0, 20))
+        
+        # Recording mode options
+        options_frame = ttk.Frame(main_frame)
+        options_frame.grid(row=5, column=0, columnspan=2, sticky=tk.W)
+        
+        self.replay_var = tk.BooleanVar(value=False)
+        replay_check = ttk.Checkbutton(options_frame, variable=self.replay_var,
+                                       text=f"Replay buffer: keep only the last {self.replay_seconds} seconds")
+        replay_check.grid(row=0, column=0, sticky=tk.W)
+        
+        self.adaptive_var = tk.BooleanVar(value=False)
+        adaptive_check = ttk.Checkbutton(options_frame, variable=self.adaptive_var,
+                                         text="Lower the frame rate when the computer can't keep up")
+        adaptive_check.grid(row=1, column=0, sticky=tk.W)
         
         # Control buttons frame
         button_frame = ttk.Frame(main_frame)
-        button_frame.grid(row=3, column=0, columnspan=2, pady=(20, 0))
+        button_frame.grid(row=6, column=0, columnspan=2, pady=(20, 0))
         
         # Recording control buttons
-        self.start_button = ttk.Button(button_frame, text="Start Recording", 
+        self.start_button = ttk.Button(button_frame, text="Start Recording",
                                      command=self.start_recording, width=15)
         self.start_button.grid(row=0, column=0, padx=(0, 10))
         
-        self.pause_button = ttk.Button(button_frame, text="Pause", 
+        self.pause_button = ttk.Button(button_frame, text="Pause",
                                      command=self.pause_recording, width=15, state="disabled")
         self.pause_button.grid(row=0, column=1, padx=(0, 10))
         
-        self.stop_button = ttk.Button(button_frame, text="Stop Recording", 
+        self.stop_button = ttk.Button(button_frame, text="Stop Recording",
                                     command=self.stop_recording, width=15, state="disabled")
         self.stop_button.grid(row=1, column=0, pady=(10, 0), padx=(0, 10))
         
-        self.resume_button = ttk.Button(button_frame, text="Resume", 
+        self.resume_button = ttk.Button(button_frame, text="Resume",
                                       command=self.resume_recording, width=15, state="disabled")
         self.resume_button.grid(row=1, column=1, pady=(10, 0))
         
+        self.save_replay_button = ttk.Button(button_frame, text="Save Replay",
+                                           command=self.save_replay, width=15, state="disabled")
+        self.save_replay_button.grid(row=2, column=0, pady=(10, 0), padx=(0, 10))
+        
+        self.cancel_jobs_button = ttk.Button(button_frame, text="Cancel Processing",
+                                           command=self.cancel_jobs, width=15, state="disabled")
+        self.cancel_jobs_button.grid(row=2, column=1, pady=(10, 0))
+        
         # Status label
         self.status_label = ttk.Label(main_frame, text="Ready to record", foreground="green")
-        self.status_label.grid(row=4, column=0, columnspan=2, pady=(30, 0))
+        self.status_label.grid(row=7, column=0, columnspan=2, pady=(30, 0))
         
         # Progress frame
         progress_frame = ttk.Frame(main_frame)
-        progress_frame.grid(row=5, column=0, columnspan=2, pady=(20, 0), sticky=tk.W+tk.E)
+        progress_frame.grid(row=8, column=0, columnspan=2, pady=(20, 0), sticky=tk.W+tk.E)
         
         # Recording time label
         self.time_label = ttk.Label(progress_frame, text="Recording Time: 00:00:00")
         self.time_label.grid(row=0, column=0, sticky=tk.W)
         
+        # Video pipeline health
+        self.video_label = ttk.Label(progress_frame, text="")
+        self.video_label.grid(row=1, column=0, sticky=tk.W)
+        
+        # Audio stream health
+        self.audio_label = ttk.Label(progress_frame, text="")
+        self.audio_label.grid(row=2, column=0, sticky=tk.W)
+        
+        # Recordings still being finished in the background
+        self.jobs_label = ttk.Label(progress_frame, text="")
+        self.jobs_label.grid(row=3, column=0, sticky=tk.W)
+        
         # Output location display
         self.output_label = ttk.Label(main_frame, text="", wraplength=450, foreground="blue")
-        self.output_label.grid(row=6, column=0, columnspan=2, pady=(20, 0))
+        self.output_label.grid(row=9, column=0, columnspan=2, pady=(20, 0))
     
     def show_environment_warning(self):
         """Show warning for non-Windows environments"""
@@ -162,315 +4116,207 @@ class ScreenRecorder:
                       "For full functionality, please run this application on a Windows 10 "
                       "machine with Python and the required dependencies installed.")
         messagebox.showwarning("Environment Notice", warning_msg)
-        
-    def get_screen_size(self):
-        """Get current screen size"""
-        return pyautogui.size()
-    
-    def calculate_recording_resolution(self, target_resolution):
-        """Calculate actual recording resolution based on screen size and target"""
-        screen_width, screen_height = self.get_screen_size()
-        target_width, target_height = target_resolution
-        
-        # Scale down if screen is smaller than target resolution
-        if screen_width < target_width or screen_height < target_height:
-            scale = min(screen_width / target_width, screen_height / target_height)
-            actual_width = int(target_width * scale)
-            actual_height = int(target_height * scale)
-            # Ensure even dimensions for video encoding
-            actual_width = actual_width if actual_width % 2 == 0 else actual_width - 1
-            actual_height = actual_height if actual_height % 2 == 0 else actual_height - 1
-            return (actual_width, actual_height)
-        else:
-            return target_resolution
-    
-    def setup_audio_recording(self):
-        """Setup audio recording based on selected option"""
-        audio_option = self.audio_options[self.audio_var.get()]
-        
-        if audio_option == "none":
-            return False
-            
-        try:
-            # Initialize PyAudio
-            self.audio = pyaudio.PyAudio()
-            
-            # Find appropriate audio device
-            device_index = None
-            if audio_option == "system_mic":
-                # Use default input device
-                device_index = None
-            elif audio_option == "external_mic":
-                # Try to find external microphone (this is a simplified approach)
-                for i in range(self.audio.get_device_count()):
-                    device_info = self.audio.get_device_info_by_index(i)
-                    device_name = str(device_info.get('name', ''))
-                    max_input_channels = device_info.get('maxInputChannels', 0)
-                    if isinstance(max_input_channels, (int, float)) and max_input_channels > 0 and 'headset' in device_name.lower():
-                        device_index = i
-                        break
-                # If no specific external mic found, use default
-                if device_index is None:
-                    device_index = None
-            
-            # Create audio stream
-            self.audio_stream = self.audio.open(
-                format=self.audio_format,
-                channels=self.audio_channels,
-                rate=self.audio_rate,
-                input=True,
-                input_device_index=device_index,
-                frames_per_buffer=self.audio_chunk
-            )
-            
-            return True
-            
-        except Exception as e:
-            print(f"Audio setup error: {e}")
-            return False
-    
-    def record_audio(self):
-        """Record audio in a separate thread"""
-        self.audio_frames = []
-        
-        try:
-            while self.is_recording:
-                if not self.is_paused and self.audio_stream:
-                    data = self.audio_stream.read(self.audio_chunk, exception_on_overflow=False)
-                    self.audio_frames.append(data)
-                else:
-                    time.sleep(0.1)  # Sleep when paused
-        except Exception as e:
-            print(f"Audio recording error: {e}")
     
-    def save_audio(self):
-        """Save recorded audio to temporary file"""
-        if not self.audio_frames:
-            return None
-            
-        try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            temp_audio_file = f"temp_audio_{timestamp}.wav"
-            
-            with wave.open(temp_audio_file, 'wb') as wf:
-                wf.setnchannels(self.audio_channels)
-                wf.setsampwidth(self.audio.get_sample_size(self.audio_format))
-                wf.setframerate(self.audio_rate)
-                wf.writeframes(b''.join(self.audio_frames))
-                
-            return temp_audio_file
-            
-        except Exception as e:
-            print(f"Audio save error: {e}")
-            return None
+    def show_recovery(self):
+        """Tell the user what happened to the audio of a recording that crashed"""
+        lines = describe_recovery(self.recovery)
+        self.output_label.config(text=lines[-1])
+        messagebox.showinfo("Recovered Recording",
+                          "The recorder did not close properly last time.\n\n" + "\n".join(lines))
     
-    def merge_audio_video(self, video_file, audio_file):
-        """Merge audio and video files using moviepy"""
-        try:
-            # Load video and audio clips
-            video_clip = VideoFileClip(video_file)
-            audio_clip = AudioFileClip(audio_file)
-            
-            # Get minimum duration to avoid sync issues
-            min_duration = min(video_clip.duration, audio_clip.duration)
-            
-            # Trim clips to same duration
-            video_clip = video_clip.subclip(0, min_duration)
-            audio_clip = audio_clip.subclip(0, min_duration)
-            
-            # Set audio to video
-            final_clip = video_clip.set_audio(audio_clip)
-            
-            # Create output filename for final video
-            base_name = os.path.splitext(video_file)[0]
-            final_output = f"{base_name}_with_audio.mp4"
-            
-            # Write final video with audio
-            final_clip.write_videofile(final_output, codec='libx264', audio_codec='aac', verbose=False, logger=None)
-            
-            # Close clips to free memory
-            video_clip.close()
-            audio_clip.close()
-            final_clip.close()
-            
-            # Replace original video file with merged version
-            try:
-                os.remove(video_file)
-                os.rename(final_output, video_file)
-            except:
-                # If renaming fails, keep both files
-                self.output_filename = final_output
-            
-            return True
-            
-        except Exception as e:
-            print(f"Audio-video merge error: {e}")
-            return False
+    def build_config(self):
+        """Read the UI selections into a RecordingConfig"""
+        capture_area = self.capture_area_options[self.capture_area_var.get()]
+        multi_monitor = capture_area if isinstance(capture_area, str) else None
+        return RecordingConfig(
+            resolution=self.resolution_options[self.resolution_var.get()],
+            fps=self.fps_options[self.fps_var.get()],
+            region=None if multi_monitor else capture_area,
+            multi_monitor=multi_monitor,
+            audio_source=self.audio_options[self.audio_var.get()],
+            audio_rate=self.audio_rate,
+            audio_chunk=self.audio_chunk,
+            replay_seconds=self.replay_seconds if self.replay_var.get() else None,
+            adaptive_quality=self.adaptive_var.get()
+        )
     
-    def record_video(self):
-        """Record video in a separate thread"""
-        start_time = time.time()
-        
-        try:
-            while self.is_recording:
-                if not self.is_paused:
-                    # Capture screenshot
-                    screenshot = pyautogui.screenshot()
-                    frame = np.array(screenshot)
-                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                    
-                    # Resize frame to target resolution if needed
-                    target_resolution = self.resolution_options[self.resolution_var.get()]
-                    actual_resolution = self.calculate_recording_resolution(target_resolution)
-                    
-                    if frame.shape[:2][::-1] != actual_resolution:
-                        frame = cv2.resize(frame, actual_resolution)
-                    
-                    # Write frame to video
-                    if self.video_writer:
-                        self.video_writer.write(frame)
-                    
-                    # Update recording time
-                    elapsed_time = int(time.time() - start_time)
-                    time_str = f"{elapsed_time // 3600:02d}:{(elapsed_time % 3600) // 60:02d}:{elapsed_time % 60:02d}"
-                    self.root.after(0, lambda: self.time_label.config(text=f"Recording Time: {time_str}"))
-                    
-                    # Control frame rate (approximately 30 FPS)
-                    time.sleep(1/30)
-                else:
-                    time.sleep(0.1)  # Sleep when paused
-                    
-        except Exception as e:
-            print(f"Video recording error: {e}")
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Video recording failed: {e}"))
+    def update_recording_status(self):
+        """Poll an engine metrics snapshot a few times a second while recording"""
+        engine = self.engine
+        if engine is None or not engine.is_recording:
+            return
+        
+        metrics = engine.metrics()
+        
+        # Update recording time
+        elapsed_time = int(metrics["elapsed"])
+        time_str = f"{elapsed_time // 3600:02d}:{(elapsed_time % 3600) // 60:02d}:{elapsed_time % 60:02d}"
+        self.time_label.config(text=f"Recording Time: {time_str}")
+        
+        video = metrics["video"]
+        if video:
+            self.video_label.config(
+                text=f"Video: {video['capture_fps']:.1f} of {video['capture_target_fps']:g} FPS, "
+                     f"{video['dropped_frames']} dropped, {video['duplicated_frames']} repeated")
+        
+        if engine.saved_replays:
+            self.output_label.config(text=f"{len(engine.saved_replays)} replays saved, latest: "
+                                          f"{os.path.abspath(engine.saved_replays[-1])}")
+        
+        stats = metrics["audio"]
+        if stats:
+            self.audio_label.config(
+                text=f"Audio: {stats['overflows']} overflows, {stats['dropped_samples']} samples dropped, "
+                     f"{stats['latency_ms']:.0f} ms latency")
+        
+        if engine.error is not None and not self.error_reported:
+            self.error_reported = True
+            messagebox.showerror("Error", f"Video recording failed: {engine.error}")
+        
+        self.root.after(250, self.update_recording_status)
     
     def start_recording(self):
         """Start the recording process"""
         try:
-            # Generate output filename
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.output_filename = f"screen_recording_{timestamp}.mp4"
-            
-            # Get recording resolution
-            target_resolution = self.resolution_options[self.resolution_var.get()]
-            actual_resolution = self.calculate_recording_resolution(target_resolution)
-            
-            # Setup video writer
-            fourcc = cv2.VideoWriter.fourcc(*'mp4v')
-            self.video_writer = cv2.VideoWriter(self.output_filename, fourcc, 30.0, actual_resolution)
-            
-            if not self.video_writer.isOpened():
-                raise Exception("Failed to initialize video writer")
-            
-            # Setup audio recording if selected
-            audio_enabled = self.setup_audio_recording()
+            self.engine = RecordingEngine(self.build_config())
+            self.error_reported = False
+            audio_enabled = self.engine.start()
             
             # Update UI state
-            self.is_recording = True
-            self.is_paused = False
             self.start_button.config(state="disabled")
             self.pause_button.config(state="normal")
             self.stop_button.config(state="normal")
             
+            if self.engine.config.replay_seconds:
+                self.save_replay_button.config(state="normal")
+            
             # Show recording status with audio info
             audio_status = " (with audio)" if audio_enabled else " (video only)"
             self.status_label.config(text=f"Recording...{audio_status}", foreground="red")
             
-            # Start recording threads
-            self.video_thread = threading.Thread(target=self.record_video, daemon=True)
-            self.video_thread.start()
-            
-            if audio_enabled:
-                self.audio_thread = threading.Thread(target=self.record_audio, daemon=True)
-                self.audio_thread.start()
-            
+            self.update_recording_status()
+        
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start recording: {e}")
             self.reset_ui_state()
     
+    def save_replay(self):
+        """Save the replay buffer in the background; recording carries on"""
+        try:
+            path = self.engine.save_replay()
+            self.output_label.config(text=f"Saving replay to: {os.path.abspath(path)}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save replay: {e}")
+    
     def pause_recording(self):
         """Pause the recording"""
-        self.is_paused = True
+        self.engine.pause()
         self.pause_button.config(state="disabled")
         self.resume_button.config(state="normal")
         self.status_label.config(text="Recording Paused", foreground="orange")
     
     def resume_recording(self):
         """Resume the recording"""
-        self.is_paused = False
+        self.engine.resume()
         self.pause_button.config(state="normal")
         self.resume_button.config(state="disabled")
         self.status_label.config(text="Recording...", foreground="red")
     
     def stop_recording(self):
-        """Stop the recording and save the file"""
+        """Stop the recording and finish the file in the background"""
         try:
-            # Stop recording
-            self.is_recording = False
-            
-            # Wait for threads to finish
-            if self.video_thread and self.video_thread.is_alive():
-                self.video_thread.join(timeout=5)
-            
-            if self.audio_thread and self.audio_thread.is_alive():
-                self.audio_thread.join(timeout=5)
-            
-            # Release video writer
-            if self.video_writer:
-                self.video_writer.release()
-                self.video_writer = None
-            
-            # Clean up audio
-            if self.audio_stream:
-                self.audio_stream.stop_stream()
-                self.audio_stream.close()
-                self.audio_stream = None
-            
-            if hasattr(self, 'audio'):
-                self.audio.terminate()
-            
-            # Save and merge audio if recorded
-            if self.audio_frames and MOVIEPY_AVAILABLE:
-                self.status_label.config(text="Processing audio...", foreground="orange")
-                self.root.update()
-                
-                temp_audio_file = self.save_audio()
-                if temp_audio_file:
-                    self.temp_audio_file = temp_audio_file
-                    # Merge audio and video using moviepy
-                    success = self.merge_audio_video(self.output_filename, temp_audio_file)
-                    if not success:
-                        messagebox.showwarning("Audio Warning", 
-                                             f"Video saved successfully but audio merge failed.\n"
-                                             f"Video: {self.output_filename}\n"
-                                             f"Audio: {temp_audio_file}")
-                    else:
-                        # Clean up temporary audio file
-                        try:
-                            os.remove(temp_audio_file)
-                        except:
-                            pass
-            elif self.audio_frames and not MOVIEPY_AVAILABLE:
-                # Save audio separately if moviepy not available
-                temp_audio_file = self.save_audio()
-                if temp_audio_file:
-                    messagebox.showinfo("Audio Saved Separately", 
-                                      f"Video: {self.output_filename}\n"
-                                      f"Audio: {temp_audio_file}\n\n"
-                                      f"Install moviepy to automatically merge audio/video.")
-            
-            # Reset UI state
-            self.reset_ui_state()
-            
-            # Show completion message
-            full_path = os.path.abspath(self.output_filename) if self.output_filename else ''
-            self.output_label.config(text=f"Recording saved to: {full_path}")
-            messagebox.showinfo("Recording Complete", 
-                              f"Recording saved successfully!\n\nLocation: {full_path}")
-            
+            self.finalizer.submit(self.engine)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to stop recording: {e}")
-            self.reset_ui_state()
+        
+        self.reset_ui_state()
+        self.watch_jobs()
+    
+    def cancel_jobs(self):
+        """Cancel the post-processing of every stopped recording"""
+        self.finalizer.cancel_all()
+        self.jobs_label.config(text="Cancelling...")
+    
+    def update_jobs_status(self):
+        """Poll the background jobs and report each recording once it is finished"""
+        for job in self.finalizer.pop_finished():
+            self.report_job(job)
+        
+        active = self.finalizer.active()
+        if not active:
+            self.jobs_polling = False
+            self.jobs_label.config(text="")
+            self.cancel_jobs_button.config(state="disabled")
+            if self.closing:
+                self.root.destroy()
+            return
+        
+        job = active[0]
+        self.jobs_label.config(text=f"Finishing {len(active)} recording(s): "
+                                    f"{job.message} ({job.progress:.0%})")
+        self.cancel_jobs_button.config(state="normal")
+        self.root.after(250, self.update_jobs_status)
+    
+    def watch_jobs(self):
+        """Start polling the background jobs unless that is already happening"""
+        if not self.jobs_polling:
+            self.jobs_polling = True
+            self.update_jobs_status()
+    
+    def report_job(self, job):
+        """Show where a finished recording was saved
+        
+        Dialogs would interrupt a recording that is running, so only the output label
+        is updated then.
+        """
+        quiet = self.is_recording or self.closing
+        result = job.result
+        if job.state == "failed":
+            self.output_label.config(text=f"Failed to finish recording: {job.error}")
+            if not quiet:
+                messagebox.showerror("Error", f"Failed to stop recording: {job.error}")
+            return
+        
+        output_filename = result["output_filename"]
+        audio_file = result["audio_file"]
+        
+        if "replays" in result:
+            # Replay mode keeps nothing except the replays saved along the way
+            replays = "\n".join(os.path.abspath(path) for path in result["replays"])
+            self.output_label.config(text=f"{len(result['replays'])} replays saved")
+            if not quiet:
+                messagebox.showinfo("Replay Buffer Stopped",
+                                  f"{len(result['replays'])} replays saved.\n\n{replays}")
+            return
+        
+        full_path = os.path.abspath(output_filename) if output_filename else ''
+        if result.get("outputs"):
+            full_path = "\n".join(os.path.abspath(path) for path in result["outputs"])
+        self.output_label.config(text=f"Recording saved to: {full_path}")
+        if quiet:
+            return
+        
+        if job.state == "cancelled":
+            message = f"Processing was cancelled.\n\nVideo: {full_path}"
+            if audio_file:
+                message += f"\nAudio: {audio_file}"
+            messagebox.showinfo("Processing Cancelled", message)
+            return
+        
+        if result["audio_merge_failed"]:
+            messagebox.showwarning("Audio Warning",
+                                 f"Video saved successfully but audio merge failed.\n"
+                                 f"Video: {output_filename}\n"
+                                 f"Audio: {audio_file}")
+        elif audio_file:
+            messagebox.showinfo("Audio Saved Separately",
+                              f"Video: {output_filename}\n"
+                              f"Audio: {audio_file}\n\n"
+                              f"Install moviepy to automatically merge audio/video.")
+        
+        # Show completion message
+        messagebox.showinfo("Recording Complete",
+                          f"Recording saved successfully!\n\nLocation: {full_path}")
     
     def reset_ui_state(self):
         """Reset UI to initial state"""
@@ -478,21 +4324,273 @@ class ScreenRecorder:
         self.pause_button.config(state="disabled")
         self.resume_button.config(state="disabled")
         self.stop_button.config(state="disabled")
+        self.save_replay_button.config(state="disabled")
         self.status_label.config(text="Ready to record", foreground="green")
         self.time_label.config(text="Recording Time: 00:00:00")
+        self.video_label.config(text="")
+        self.audio_label.config(text="")
     
     def on_closing(self):
         """Handle application closing"""
         if self.is_recording:
-            if messagebox.askokcancel("Quit", "Recording is in progress. Stop recording and quit?"):
-                self.stop_recording()
-                self.root.destroy()
-        else:
-            self.root.destroy()
+            if not messagebox.askokcancel("Quit", "Recording is in progress. Stop recording and quit?"):
+                return
+            self.stop_recording()
+        
+        pending = len(self.finalizer.active())
+        if pending:
+            answer = messagebox.askyesnocancel(
+                "Quit", f"{pending} recording(s) are still being finished.\n\n"
+                        f"Yes: wait for them, then quit.\n"
+                        f"No: cancel processing and quit now; videos are kept and "
+                        f"audio stays in a separate file.")
+            if answer is None:
+                return
+            if answer:
+                # update_jobs_status closes the window once the last job is done
+                self.closing = True
+                self.status_label.config(text="Finishing recordings before quitting...",
+                                         foreground="orange")
+                self.start_button.config(state="disabled")
+                self.watch_jobs()
+                return
+            self.finalizer.cancel_all()
+            self.finalizer.wait(timeout=10)
+        self.root.destroy()
 
 
-def main():
-    """Main function to run the application"""
+# Short resolution names accepted on the command line
+CLI_RESOLUTIONS = {
+    "720p": RESOLUTION_OPTIONS["HD (720p)"],
+    "1080p": RESOLUTION_OPTIONS["Full HD (1080p)"],
+    "4k": RESOLUTION_OPTIONS["4K (2160p)"],
+}
+
+
+def parse_region(value):
+    """Parse a LEFT,TOP,WIDTH,HEIGHT command-line rectangle"""
+    try:
+        left, top, width, height = (int(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected LEFT,TOP,WIDTH,HEIGHT")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("width and height must be positive")
+    return (left, top, width, height)
+
+
+def positive_float(value):
+    """Parse a command-line number that must be greater than zero"""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number, got {value!r}")
+    if not (number > 0 and math.isfinite(number)):
+        raise argparse.ArgumentTypeError("must be a positive number")
+    return number
+
+
+def build_arg_parser():
+    """Command-line options for headless recording"""
+    parser = argparse.ArgumentParser(
+        prog="screen_recorder",
+        description="Screen recorder. Opens the GUI unless --headless is given.")
+    parser.add_argument("--headless", action="store_true",
+                        help="record from the command line without opening a window")
+    parser.add_argument("-o", "--output", help="output MP4 file (default: timestamped name)")
+    parser.add_argument("-d", "--duration", type=float,
+                        help="seconds to record (default: until Ctrl+C)")
+    parser.add_argument("--fps", type=positive_float, default=30.0,
+                        help="frames per second (default: 30)")
+    parser.add_argument("--resolution", choices=sorted(CLI_RESOLUTIONS), default="1080p",
+                        help="output resolution preset (default: 1080p)")
+    
+    area = parser.add_mutually_exclusive_group()
+    area.add_argument("--region", type=parse_region, metavar="LEFT,TOP,WIDTH,HEIGHT",
+                      help="record only this rectangle of the desktop")
+    area.add_argument("--monitor", type=int, metavar="N", help="record only monitor N (1-based)")
+    area.add_argument("--window", metavar="TITLE", help="follow the window whose title contains TITLE")
+    area.add_argument("--all-monitors", choices=["composite", "separate"],
+                      help="record every monitor, side by side in one file or in one file each")
+    
+    parser.add_argument("--backend", default="auto",
+                        choices=["auto", "mock", *CAPTURE_BACKENDS],
+                        help="screen capture backend (default: auto)")
+    parser.add_argument("--encoder", default="auto", choices=["auto", "ffmpeg", "opencv"],
+                        help="video encoder (default: auto)")
+    parser.add_argument("--codec", default=DEFAULT_ENCODER_OPTIONS["codec"],
+                        choices=FFmpegVideoWriter.CODECS, help="ffmpeg video codec")
+    parser.add_argument("--preset", default=DEFAULT_ENCODER_OPTIONS["preset"],
+                        choices=FFmpegVideoWriter.PRESETS, help="ffmpeg encoder preset")
+    parser.add_argument("--crf", type=int, default=DEFAULT_ENCODER_OPTIONS["crf"],
+                        help="ffmpeg constant rate factor (lower is better quality)")
+    parser.add_argument("--threads", type=int, default=DEFAULT_ENCODER_OPTIONS["threads"],
+                        help="ffmpeg encoder threads (0 = automatic)")
+    parser.add_argument("--audio", default="none", choices=AUDIO_SOURCES,
+                        help="audio input to record (default: none)")
+    parser.add_argument("--segment-seconds", type=float, metavar="SECONDS",
+                        help="start a new file every SECONDS and list the files in a manifest")
+    parser.add_argument("--segment-mb", type=float, metavar="MB",
+                        help="start a new file once the current one reaches MB megabytes")
+    parser.add_argument("--stitch", action="store_true",
+                        help="join the segments into the output file when recording stops")
+    parser.add_argument("--replay", type=float, metavar="SECONDS",
+                        help="keep only the last SECONDS in memory; press Enter to save them")
+    parser.add_argument("--stream-port", type=int, metavar="PORT",
+                        help="also stream the recording live as MJPEG over HTTP on PORT (0 = any free port)")
+    parser.add_argument("--stream-host", default="127.0.0.1", metavar="HOST",
+                        help="address the live stream listens on (default: 127.0.0.1)")
+    parser.add_argument("--stream-fps", type=float, default=10.0, metavar="FPS",
+                        help="frame rate of the live stream (default: 10)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="lower the frame rate (and with segments the resolution and preset) "
+                             "while the computer cannot keep up")
+    parser.add_argument("--stats", action="store_true",
+                        help="print a metrics summary line at every metrics interval")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="append metrics snapshots to this JSON-lines file")
+    parser.add_argument("--metrics-interval", type=float, default=1.0, metavar="SECONDS",
+                        help="seconds between metrics snapshots (default: 1)")
+    return parser
+
+
+def config_from_args(args):
+    """Build a RecordingConfig from parsed command-line options"""
+    if args.region:
+        region = CaptureRegion("rect", rect=args.region)
+    elif args.monitor is not None:
+        region = CaptureRegion("monitor", monitor=args.monitor)
+    elif args.window:
+        region = CaptureRegion("window", window_title=args.window)
+    else:
+        region = CaptureRegion()
+    
+    return RecordingConfig(
+        output_filename=args.output,
+        resolution=CLI_RESOLUTIONS[args.resolution],
+        fps=args.fps,
+        region=region,
+        capture_backend=args.backend,
+        audio_source=args.audio,
+        metrics_interval=args.metrics_interval,
+        segment_seconds=args.segment_seconds,
+        segment_megabytes=args.segment_mb,
+        stitch_segments=args.stitch,
+        replay_seconds=args.replay,
+        multi_monitor=args.all_monitors,
+        stream_port=args.stream_port,
+        stream_host=args.stream_host,
+        stream_fps=args.stream_fps,
+        adaptive_quality=args.adaptive,
+        video_encoder=args.encoder,
+        encoder_options={
+            "codec": args.codec,
+            "preset": args.preset,
+            "crf": args.crf,
+            "threads": args.threads
+        }
+    )
+
+
+def run_headless(args):
+    """Record from the command line; returns the process exit code"""
+    try:
+        config = config_from_args(args)
+    except ValueError as e:
+        print(f"Invalid options: {e}")
+        return 2
+    engine = RecordingEngine(config, on_status=print)
+    
+    # Clear up after a recorder that crashed, recovering its audio
+    for directory in {".", os.path.dirname(args.output or "") or "."}:
+        report = TempFileJournal.clean_up_stale(directory)
+        for path in report["removed"]:
+            print(f"Removed stale temporary file: {path}")
+        for line in describe_recovery(report):
+            print(line)
+    
+    metrics_writer = MetricsJsonLinesWriter(args.metrics_file) if args.metrics_file else None
+    if metrics_writer:
+        engine.add_metrics_sink(metrics_writer)
+    if args.stats:
+        engine.add_metrics_sink(lambda snapshot: print(format_metrics(snapshot)))
+    
+    try:
+        audio_enabled = engine.start()
+    except Exception as e:
+        print(f"Failed to start recording: {e}", file=sys.stderr)
+        if metrics_writer:
+            metrics_writer.close()
+        return 1
+    
+    if args.replay:
+        print(f"Replay buffer holding the last {args.replay:g}s" + (" with audio" if audio_enabled else "")
+              + "; press Enter to save it, Ctrl+C to stop")
+        threading.Thread(target=save_replays_on_enter, args=(engine,), daemon=True).start()
+    else:
+        print(f"Recording to {engine.output_filename}" + (" with audio" if audio_enabled else "")
+              + (f" for {args.duration:g}s" if args.duration else " (Ctrl+C to stop)"))
+    if engine.stream_server:
+        print(f"Streaming live at {engine.stream_server.url}")
+    
+    try:
+        while engine.error is None:
+            if args.duration and engine.elapsed() >= args.duration:
+                break
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        pass
+    
+    # Finish on a worker thread so a second Ctrl+C can cancel a long audio merge
+    finalizer = FinalizeQueue()
+    try:
+        job = finalizer.submit(engine)
+    except Exception:
+        # The recording was still queued; finish its files before giving up
+        finalizer.wait()
+        raise
+    try:
+        while not job.wait(0.1):
+            pass
+    except KeyboardInterrupt:
+        print("Cancelling; the video is kept and the audio stays in a separate file")
+        job.cancel()
+        job.wait()
+    if metrics_writer:
+        metrics_writer.close()
+    if job.state == "failed":
+        print(f"Failed to finish recording: {job.error}", file=sys.stderr)
+        return 1
+    result = job.result
+    if engine.error is not None:
+        print(f"Video recording failed: {engine.error}", file=sys.stderr)
+        return 1
+    
+    if result["audio_file"]:
+        print(f"Audio saved separately: {result['audio_file']}")
+    if result.get("segments"):
+        print(f"{len(result['segments'])} segments listed in {result['manifest']}")
+    if result.get("outputs"):
+        for path in result["outputs"][1:]:
+            print(f"Recording saved to: {os.path.abspath(path)}")
+    if args.replay:
+        print(f"{len(result['replays'])} replays saved")
+    else:
+        print(f"Recording saved to: {os.path.abspath(result['output_filename'])}")
+    return 0
+
+
+def save_replays_on_enter(engine):
+    """Save the replay buffer each time a line is read from stdin"""
+    for _ in sys.stdin:
+        try:
+            engine.save_replay()
+        except RuntimeError as e:
+            print(e)
+
+
+def run_gui():
+    """Run the Tkinter application"""
+    load_tkinter()
     root = tk.Tk()
     app = ScreenRecorder(root)
     
@@ -506,7 +4604,16 @@ def main():
     root.geometry(f"+{x}+{y}")
     
     root.mainloop()
+    return 0
+
+
+def main(argv=None):
+    """Main function to run the application"""
+    args = build_arg_parser().parse_args(argv)
+    if args.headless:
+        return run_headless(args)
+    return run_gui()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())